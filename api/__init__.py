@@ -5,9 +5,21 @@ from flask_migrate import Migrate
 from flask_restx import Api
 
 from api.auth import auth_namespace
+from api.clicks import click_buffer
+from api.code_filter import code_filter
+from api.codes import code_allocator
 from api.config import config_dict
+from api.domains import domain_registry
+from api.mail import mail_sender
 from api.models import Url, User
-from api.url_routes import redirect_namespace, url_namespace
+from api.passwords import password_hasher, passwords_cli
+from api.qr import qr_cache, qr_service
+from api.rate_limits import rate_limit_leases
+from api.redirects import RedirectMiddleware
+from api.resolution import resolution_cache
+from api.snapshot import snapshot_cli
+from api.url_routes import REDIRECT_LIMIT, Redirect, redirect_namespace, url_namespace
+from api.user_context import user_context
 from api.user_routes import user_namespace
 from api.utils import cache, db, limiter
 
@@ -37,6 +49,17 @@ def create_app(config=config_dict["dev"]):
     db.init_app(app)
     cache.init_app(app)
     limiter.init_app(app)
+    rate_limit_leases.init_app(app)
+    code_allocator.init_app(app)
+    resolution_cache.init_app(app)
+    code_filter.init_app(app)
+    domain_registry.init_app(app)
+    click_buffer.init_app(app)
+    qr_service.init_app(app)
+    qr_cache.init_app(app)
+    user_context.init_app(app)
+    password_hasher.init_app(app)
+    mail_sender.init_app(app)
 
     migrate = Migrate(app, db)  # noqa
     jwt = JWTManager(app)  # noqa
@@ -46,6 +69,13 @@ def create_app(config=config_dict["dev"]):
     api.add_namespace(url_namespace, path="/urls")
     api.add_namespace(redirect_namespace, path="/")
 
+    if app.config.get("REDIRECT_FAST_PATH", True):
+        app.wsgi_app = RedirectMiddleware(app, app.wsgi_app, REDIRECT_LIMIT, Redirect.endpoint)
+        app.extensions["redirect_middleware"] = app.wsgi_app
+
+    app.cli.add_command(snapshot_cli)
+    app.cli.add_command(passwords_cli)
+
     @app.shell_context_processor
     def make_shell_context():
         return {"db": db, "User": User, "Url": Url}
@@ -0,0 +1,258 @@
+import asyncio
+import json
+import time
+from http import HTTPStatus
+from urllib.parse import parse_qs
+
+from cachelib.serializers import RedisSerializer
+from sqlalchemy.ext.asyncio import create_async_engine
+from werkzeug.urls import iri_to_uri
+
+from api import create_app
+from api.clicks import click_buffer
+from api.code_filter import code_filter
+from api.config import config_dict
+from api.domains import DomainRegistry
+from api.models import User
+from api.rate_limits import rate_limit_leases
+from api.redirects import NOT_FOUND_BODY
+from api.resolution import ResolutionCache
+from api.url_routes import REDIRECT_LIMIT, Redirect
+from api.utils import db, limiter
+
+ASYNC_DRIVERS = {"postgresql": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
+
+
+def async_database_url(uri):
+    """Return the url of the async driver for a database url eg. postgresql:// -> postgresql+asyncpg://
+
+    Args:
+        uri: str
+    Return: str
+    """
+
+    scheme, _, rest = uri.partition("://")
+    driver = ASYNC_DRIVERS.get(scheme.split("+")[0])
+    if driver is None:
+        raise ValueError(f"No async driver known for {scheme} databases, set ASYNC_DATABASE_URL")
+    return f"{driver}://{rest}"
+
+
+def json_body(message):
+    return json.dumps({"message": message}).encode() + b"\n"
+
+
+class AsyncRedirectApp:
+    """ASGI application serving only short code redirects
+
+    A request waiting on the database or the shared cache does not hold a
+    worker, so one process can keep thousands of redirects in flight. Codes
+    are resolved like ResolutionCache does it: an in-process LRU, then the
+    shared Redis tier under the same keys and serialization as the Flask
+    workers, then the database with the same query through an async driver
+    pool. Concurrent misses of a code share one lookup. The code filter, the
+    click buffer and the rate limit leases are the ones of the Flask app
+    built with the same config; the only blocking call left, taking a new
+    lease from the limiter storage, runs in a thread. Custom domains are
+    reloaded every DOMAIN_REGISTRY_TTL seconds instead of looked up per miss.
+
+    Needs an async database driver (asyncpg or aiosqlite), serve it with any
+    ASGI server, eg. `uvicorn asgi:app`.
+
+    Configured with:
+        ASYNC_DATABASE_URL: database url of the async driver, derived from SQLALCHEMY_DATABASE_URI when empty
+        ASYNC_DB_POOL_SIZE: connections kept in the pool
+        ASYNC_DB_MAX_OVERFLOW: connections opened on top of the pool under load
+    """
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        config = flask_app.config
+        self.default_domain = config["DEFAULT_DOMAIN"]
+        self.domain_ttl = config.get("DOMAIN_REGISTRY_TTL", 300)
+        self.endpoint = Redirect.endpoint
+        self.entries = ResolutionCache(
+            maxsize=config.get("RESOLUTION_CACHE_SIZE", 10000),
+            timeout=config.get("RESOLUTION_CACHE_TIMEOUT", 300),
+            local_timeout=config.get("RESOLUTION_CACHE_LOCAL_TIMEOUT", 5),
+        )
+
+        url = config.get("ASYNC_DATABASE_URL") or async_database_url(config["SQLALCHEMY_DATABASE_URI"])
+        options = {}
+        if not url.startswith("sqlite"):
+            options = {
+                "pool_size": config.get("ASYNC_DB_POOL_SIZE", 20),
+                "max_overflow": config.get("ASYNC_DB_MAX_OVERFLOW", 100),
+            }
+        try:
+            self.engine = create_async_engine(url, **options)
+        except ModuleNotFoundError as e:
+            raise RuntimeError("The ASGI redirect server needs an async database driver, eg. asyncpg") from e
+
+        self.redis = None
+        if config.get("RESOLUTION_CACHE_SHARED"):
+            import redis.asyncio
+
+            self.redis = redis.asyncio.from_url(config["CACHE_REDIS_URL"])
+        self.redis_prefix = f"{config.get('CACHE_KEY_PREFIX', 'flask_cache_')}{ResolutionCache.key_prefix}"
+        self.serializer = RedisSerializer()
+
+        self._loads = {}
+        self._hosts = set()
+        self._hosts_loaded_at = None
+        self._hosts_lock = asyncio.Lock()
+        self.served = 0
+        self.coalesced = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+
+        try:
+            status, headers, body = await self.handle(scope)
+        except Exception:
+            self.flask_app.logger.exception("Failed to serve a redirect")
+            status, headers, body = HTTPStatus.INTERNAL_SERVER_ERROR, [], json_body("Internal Server Error")
+        if scope["method"] == "HEAD":
+            body = b""
+        headers.append((b"content-length", str(len(body)).encode()))
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def close(self):
+        await asyncio.to_thread(click_buffer.flush)
+        await self.engine.dispose()
+        if self.redis is not None:
+            await self.redis.close()
+
+    async def handle(self, scope):
+        """Answer one request
+
+        Args:
+            scope: ASGI http scope
+        Return: (status, headers, body)
+        """
+
+        json_headers = [(b"content-type", b"application/json")]
+        if scope["method"] not in ("GET", "HEAD"):
+            return HTTPStatus.METHOD_NOT_ALLOWED, json_headers + [(b"allow", b"GET, HEAD")], json_body(
+                "The method is not allowed for the requested URL."
+            )
+        path = scope["path"]
+        code = path[1:]
+        if not code or "/" in code:
+            return HTTPStatus.NOT_FOUND, json_headers, NOT_FOUND_BODY.encode()
+
+        headers = dict(scope["headers"])
+        host = headers.get(b"host", b"").decode("latin-1")
+        host_url = f"{scope.get('scheme', 'http')}://{host}{scope.get('root_path', '')}/"
+        if host_url != self.default_domain and not await self.owns_host(host):
+            return HTTPStatus.NOT_FOUND, json_headers, NOT_FOUND_BODY.encode()
+
+        client = scope.get("client")
+        if limiter.enabled and not await self.within_limit(client[0] if client else "127.0.0.1"):
+            return HTTPStatus.TOO_MANY_REQUESTS, json_headers, json_body(f"{REDIRECT_LIMIT} exceeded")
+
+        target = None if code_filter.rejects(code) else await self.resolve(code)
+        if target is None:
+            return HTTPStatus.NOT_FOUND, json_headers, NOT_FOUND_BODY.encode()
+
+        query = parse_qs(scope.get("query_string", b"").decode("latin-1"), keep_blank_values=True)
+        click_buffer.record(target["id"], query.get("referrer", [None])[0])
+        self.served += 1
+        location = iri_to_uri(target["long_url"], safe_conversion=True)
+        return HTTPStatus.FOUND, [(b"location", location.encode("latin-1"))], b""
+
+    async def within_limit(self, key):
+        if rate_limit_leases.spend(REDIRECT_LIMIT, key, self.endpoint):
+            return True
+        return await asyncio.to_thread(self._take_lease, key)
+
+    def _take_lease(self, key):
+        if rate_limit_leases.lease_size > 1 and rate_limit_leases.take(REDIRECT_LIMIT, key, self.endpoint):
+            return True
+        return rate_limit_leases.hit(REDIRECT_LIMIT, key, self.endpoint)
+
+    async def owns_host(self, host):
+        if self._hosts_loaded_at is None or time.monotonic() - self._hosts_loaded_at > self.domain_ttl:
+            async with self._hosts_lock:
+                if self._hosts_loaded_at is None or time.monotonic() - self._hosts_loaded_at > self.domain_ttl:
+                    await self.load_hosts()
+        return host in self._hosts
+
+    async def load_hosts(self):
+        """Load the hosts of every custom domain"""
+
+        statement = db.select(User.custom_domain).where(User.custom_domain.isnot(None))
+        async with self.engine.connect() as connection:
+            domains = (await connection.execute(statement)).scalars().all()
+        self._hosts = {DomainRegistry.host_of(domain) for domain in domains} - {None}
+        self._hosts_loaded_at = time.monotonic()
+
+    async def resolve(self, code):
+        """Read-through lookup of a short code, concurrent misses of a code share one lookup
+
+        Args:
+            code: str
+        Return: entry: dict or None if the code does not exist
+        """
+
+        entry = self.entries.get(code)
+        if entry is not None:
+            return entry
+        task = self._loads.get(code)
+        if task is None:
+            task = self._loads[code] = asyncio.ensure_future(self._load(code))
+            task.add_done_callback(lambda _: self._loads.pop(code, None))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    async def _load(self, code):
+        entry = await self._get_shared(code)
+        if entry is None:
+            async with self.engine.connect() as connection:
+                row = (await connection.execute(ResolutionCache.load_statement(code))).first()
+            entry = ResolutionCache.entry_from_row(code, row)
+            if entry is None:
+                return None
+            await self._set_shared(code, entry)
+        self.entries.set(code, entry)
+        return entry
+
+    async def _get_shared(self, code):
+        if self.redis is None:
+            return None
+        try:
+            value = await self.redis.get(f"{self.redis_prefix}{code}")
+        except Exception:
+            return None
+        return None if value is None else self.serializer.loads(value)
+
+    async def _set_shared(self, code, entry):
+        if self.redis is None:
+            return
+        try:
+            await self.redis.setex(f"{self.redis_prefix}{code}", self.entries.timeout, self.serializer.dumps(entry))
+        except Exception:
+            pass
+
+    def stats(self):
+        return {"served": self.served, "coalesced": self.coalesced, "resolution": self.entries.stats()}
+
+
+def create_asgi_app(config=config_dict["dev"]):
+    return AsyncRedirectApp(create_app(config))
@@ -4,10 +4,11 @@ import validators
 from flask import request
 from flask_jwt_extended import create_access_token, create_refresh_token, get_jwt_identity, jwt_required
 from flask_restx import Namespace, Resource, abort, fields
-from werkzeug.security import check_password_hash, generate_password_hash
 
+from api.mail import MailService
 from api.models import User
-from api.utils import MailService, TokenService, db
+from api.passwords import password_hasher
+from api.utils import TokenService, db
 
 auth_namespace = Namespace("Auth", description="auth namespace")
 
@@ -114,7 +115,7 @@ class Register(Resource):
         if User.query.filter_by(email=email).first():
             abort(HTTPStatus.CONFLICT, "Email is already taken")
 
-        password_hash = generate_password_hash(password)
+        password_hash = password_hasher.hash(password)
         new_user = User(
             username=username, firstname=firstname, lastname=lastname, email=email, password_hash=password_hash
         )
@@ -141,7 +142,11 @@ class Login(Resource):
             or User.query.filter_by(username=username_or_email).first()
         )
 
-        if user and check_password_hash(user.password_hash, password):
+        if user and password_hasher.check(user.password_hash, password):
+            if password_hasher.needs_rehash(user.password_hash):
+                # the hashing method or cost changed since the password was set
+                user.password_hash = password_hasher.hash(password)
+                user.update()
             user.access_token = create_access_token(identity=user.id)
             user.refresh_token = create_refresh_token(identity=user.id)
             user.token_type = "bearer"
@@ -199,7 +204,7 @@ class ConfirmPasswordReset(Resource):
                 if TokenService.validate_password_reset_token(token=token, user_id=uuid):
                     user = session.get(User, uuid)
                     if user:
-                        user.password_hash = generate_password_hash(password_2)
+                        user.password_hash = password_hasher.hash(password_2)
                         user.update()
                         return {"message": "Password Reset Successfully"}, HTTPStatus.OK
                 else:
@@ -226,10 +231,10 @@ class ResetPassword(Resource):
         new_password_1 = data.get("new_password_1")
         new_password_2 = data.get("new_password_2")
 
-        if current_password and check_password_hash(user.password_hash, current_password):
+        if current_password and password_hasher.check(user.password_hash, current_password):
             if new_password_1 and new_password_2:
                 if new_password_1 == new_password_2:
-                    user.password_hash = generate_password_hash(new_password_2)
+                    user.password_hash = password_hasher.hash(new_password_2)
                     user.update()
                     return {"message": "Password Reset Successfully"}, HTTPStatus.OK
                 else:
@@ -0,0 +1,171 @@
+import atexit
+import threading
+from collections import Counter, defaultdict
+from datetime import datetime
+
+from sqlalchemy import bindparam, func, update
+
+from api.models import UNKNOWN_REFERRER, Url, UrlDailyClicks, UrlHourlyClicks, UrlReferrerCount
+from api.utils import db, increment_counters
+
+REFERRER_MAX_LENGTH = UrlReferrerCount.referrer.type.length
+
+
+class ClickBuffer:
+    """Collects redirect clicks in memory and writes them to the database in batches
+
+    Besides the lifetime click counter of every url, a flush increments the
+    referrer counters and the hourly and daily click rollups.
+
+    Clicks are flushed by a background thread every `flush_interval` seconds or
+    as soon as `flush_size` clicks are pending, and once more when the process
+    exits. With a flush interval of 0 no thread is started and the buffer is
+    only flushed when it is full or when flush() is called.
+    """
+
+    def __init__(self, flush_size=500, flush_interval=5):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.app = None
+        self._clicks = Counter()
+        self._referrers = defaultdict(Counter)
+        self._hourly = Counter()
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._exit_hook = False
+
+    def init_app(self, app):
+        self.flush_size = app.config.get("CLICK_FLUSH_SIZE", self.flush_size)
+        self.flush_interval = app.config.get("CLICK_FLUSH_INTERVAL", self.flush_interval)
+        self.app = app
+        with self._lock:
+            self._clicks.clear()
+            self._referrers.clear()
+            self._hourly.clear()
+            self._pending = 0
+        if not self._exit_hook:
+            atexit.register(self.flush)
+            self._exit_hook = True
+        app.extensions["click_buffer"] = self
+
+    def record(self, url_id, referrer=None, clicked_at=None):
+        """Count a click without touching the database
+
+        Args:
+            url_id: int
+            referrer: str or None
+            clicked_at: datetime in UTC, defaults to now
+        """
+
+        hour = (clicked_at or datetime.utcnow()).replace(minute=0, second=0, microsecond=0)
+        with self._lock:
+            self._clicks[url_id] += 1
+            self._hourly[(url_id, hour)] += 1
+            self._referrers[url_id][(referrer or UNKNOWN_REFERRER)[:REFERRER_MAX_LENGTH]] += 1
+            self._pending += 1
+            is_full = self._pending >= self.flush_size
+
+        if self.flush_interval > 0:
+            self._ensure_thread()
+            if is_full:
+                self._wakeup.set()
+        elif is_full:
+            self.flush()
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="click-buffer", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception("Failed to flush clicks")
+
+    def _drain(self):
+        with self._lock:
+            pending = self._clicks, self._referrers, self._hourly
+            self._clicks, self._referrers, self._hourly = Counter(), defaultdict(Counter), Counter()
+            self._pending = 0
+        return pending
+
+    def _restore(self, clicks, referrers, hourly):
+        with self._lock:
+            self._clicks.update(clicks)
+            for url_id, counts in referrers.items():
+                self._referrers[url_id].update(counts)
+            self._hourly.update(hourly)
+            self._pending += sum(clicks.values())
+
+    def flush(self):
+        """Write every pending click and referrer count to the database in one transaction
+
+        Return: the number of clicks written
+        """
+
+        if self.app is None:
+            return 0
+
+        with self._flush_lock, self.app.app_context():
+            clicks, referrers, hourly = self._drain()
+            if not clicks:
+                return 0
+            try:
+                self._write(clicks, referrers, hourly)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                self._restore(clicks, referrers, hourly)
+                raise
+            return sum(clicks.values())
+
+    @staticmethod
+    def _write(clicks, referrers, hourly):
+        table = Url.__table__
+        db.session.execute(
+            update(table)
+            .where(table.c.id == bindparam("url_id"))
+            .values(clicks=func.coalesce(table.c.clicks, 0) + bindparam("n")),
+            [{"url_id": url_id, "n": n} for url_id, n in clicks.items()],
+        )
+
+        # urls deleted since the clicks were recorded must not get counter or rollup rows
+        existing = set(db.session.execute(db.select(table.c.id).where(table.c.id.in_(referrers))).scalars())
+        increment_counters(
+            UrlReferrerCount.__table__,
+            ["url_id", "referrer"],
+            [
+                {"url_id": url_id, "referrer": referrer, "count": n}
+                for url_id, counts in referrers.items()
+                if url_id in existing
+                for referrer, n in counts.items()
+            ],
+        )
+
+        daily = Counter()
+        for (url_id, hour), n in hourly.items():
+            daily[(url_id, hour.replace(hour=0))] += n
+        for model, buckets in ((UrlHourlyClicks, hourly), (UrlDailyClicks, daily)):
+            increment_counters(
+                model.__table__,
+                ["url_id", "bucket_start"],
+                [
+                    {"url_id": url_id, "bucket_start": start, "clicks": n}
+                    for (url_id, start), n in buckets.items()
+                    if url_id in existing
+                ],
+                count_column="clicks",
+            )
+
+
+click_buffer = ClickBuffer()
@@ -0,0 +1,181 @@
+import hashlib
+import math
+import threading
+import time
+
+from sqlalchemy import event, func
+from sqlalchemy.exc import SQLAlchemyError
+
+from api.codes import code_allocator
+from api.models import Url
+from api.utils import db
+
+# codes made by the code allocator are hashids of at least this many characters, older codes are shorter
+HASHID_MIN_LENGTH = 7
+
+
+class CodeFilter:
+    """Answers "this short code certainly does not exist" without a database round trip
+
+    Codes of HASHID_MIN_LENGTH or more characters are hashids, one that does
+    not decode cannot exist. Shorter codes were made at random before the code
+    allocator, they are kept in a Bloom filter built at startup. New short
+    codes are added when their url is inserted, deleted ones stay in the
+    filter until it is rebuilt every `rebuild_interval` seconds in the
+    background, which also picks up codes inserted by other workers.
+
+    Until the filter is loaded every code passes. A rebuild interval of 0
+    turns rebuilding off, the filter is then only loaded by init_app.
+    """
+
+    def __init__(self, capacity=100000, error_rate=0.001, rebuild_interval=3600):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.rebuild_interval = rebuild_interval
+        self.app = None
+        self._bits = None
+        self._size = 0
+        self._hashes = 0
+        self._added = []
+        self._loading = False
+        self._loaded_at = None
+        self._rebuilding = False
+        self._lock = threading.Lock()
+        self._listening = False
+        self.rejected = 0
+
+    def init_app(self, app):
+        self.capacity = app.config.get("CODE_FILTER_CAPACITY", self.capacity)
+        self.error_rate = app.config.get("CODE_FILTER_ERROR_RATE", self.error_rate)
+        self.rebuild_interval = app.config.get("CODE_FILTER_REBUILD_INTERVAL", self.rebuild_interval)
+        self.app = app
+        with self._lock:
+            self._bits = None
+            self._loaded_at = None
+            self.rejected = 0
+        if not self._listening:
+            event.listen(Url, "after_insert", self._after_insert)
+            self._listening = True
+        with app.app_context():
+            try:
+                self.load()
+            except SQLAlchemyError:
+                # the tables may not exist yet, codes pass until the next rebuild
+                db.session.rollback()
+        app.extensions["code_filter"] = self
+
+    @staticmethod
+    def is_hashid(code):
+        return len(code) >= HASHID_MIN_LENGTH
+
+    def _positions(self, code, size, hashes):
+        digest = hashlib.blake2b(code.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % size for i in range(hashes)]
+
+    def _set_bits(self, bits, size, hashes, code):
+        for position in self._positions(code, size, hashes):
+            bits[position >> 3] |= 1 << (position & 7)
+
+    def load(self):
+        """Build the filter from every short code that is not a hashid"""
+
+        with self._lock:
+            self._added = []
+            self._loading = True
+        try:
+            count = db.session.query(func.count(Url.id)).filter(func.length(Url.uuid) < HASHID_MIN_LENGTH).scalar()
+            capacity = max(self.capacity, count * 2)
+            size = math.ceil(-capacity * math.log(self.error_rate) / math.log(2) ** 2)
+            hashes = max(1, round(size / capacity * math.log(2)))
+            bits = bytearray((size + 7) // 8)
+            query = (
+                db.select(Url.uuid)
+                .where(func.length(Url.uuid) < HASHID_MIN_LENGTH)
+                .execution_options(yield_per=10000)
+            )
+            for code in db.session.execute(query).scalars():
+                self._set_bits(bits, size, hashes, code)
+        except Exception:
+            with self._lock:
+                self._loading = False
+            raise
+
+        with self._lock:
+            # codes inserted while the filter was being built
+            for code in self._added:
+                self._set_bits(bits, size, hashes, code)
+            self._bits, self._size, self._hashes = bits, size, hashes
+            self._added = []
+            self._loading = False
+            self._loaded_at = time.monotonic()
+
+    def add(self, code):
+        if self.is_hashid(code):
+            return
+        with self._lock:
+            if self._loading:
+                self._added.append(code)
+            if self._bits is not None:
+                self._set_bits(self._bits, self._size, self._hashes, code)
+
+    def might_contain(self, code):
+        bits = self._bits
+        if bits is None:
+            return True
+        positions = self._positions(code, self._size, self._hashes)
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in positions)
+
+    def rejects(self, code):
+        """Return True when a short code certainly does not exist
+
+        Args:
+            code: str
+        Return: bool
+        """
+
+        self._rebuild_if_stale()
+        if self._bits is None:
+            return False
+        if self.is_hashid(code):
+            exists = code_allocator.decode(code) is not None
+        else:
+            exists = self.might_contain(code)
+        if not exists:
+            self.rejected += 1
+        return not exists
+
+    def _rebuild_if_stale(self):
+        if self.rebuild_interval <= 0:
+            return
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at < self.rebuild_interval:
+            return
+        with self._lock:
+            if self._rebuilding:
+                return
+            self._rebuilding = True
+        threading.Thread(target=self._rebuild, name="code-filter", daemon=True).start()
+
+    def _rebuild(self):
+        try:
+            with self.app.app_context():
+                self.load()
+        except Exception:
+            self.app.logger.exception("Failed to rebuild the short code filter")
+            self._loaded_at = time.monotonic()
+        finally:
+            self._rebuilding = False
+
+    def _after_insert(self, mapper, connection, target):
+        self.add(target.uuid)
+
+    def stats(self):
+        return {
+            "bits": self._size,
+            "hashes": self._hashes,
+            "rejected": self.rejected,
+        }
+
+
+code_filter = CodeFilter()
@@ -0,0 +1,90 @@
+import threading
+
+from hashids import Hashids
+
+from api.models import Url, url_id_blocks
+from api.utils import db
+
+# every value of the url_id_blocks sequence reserves this many url ids, changing it requires a new sequence
+ID_BLOCK_SIZE = 100
+
+
+class CodeAllocator:
+    """Hands out url ids from blocks reserved in the database and encodes them into short codes
+
+    On databases with sequences a worker reserves ID_BLOCK_SIZE ids with one
+    nextval and then allocates codes without a database round trip. Since a
+    code is the hashid of the row id, codes cannot collide and decode() turns
+    a code back into the primary key of its row.
+
+    Databases without sequences (SQLite in development and tests) reserve one
+    id at a time above the largest id ever used, which is only safe for a
+    single process.
+    """
+
+    def __init__(self, salt="", min_length=7):
+        self.hashids = Hashids(salt=salt, min_length=min_length)
+        self._next_id = None
+        self._block_end = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        # codes are at least 7 characters so they never clash with the 6 character random codes made before
+        self.hashids = Hashids(salt=app.config.get("SHORT_CODE_SALT", ""), min_length=7)
+        with self._lock:
+            self._next_id = self._block_end = None
+        app.extensions["code_allocator"] = self
+
+    def _reserve(self):
+        if db.engine.dialect.supports_sequences:
+            with db.engine.begin() as conn:
+                block = conn.execute(url_id_blocks.next_value()).scalar()
+            return block * ID_BLOCK_SIZE, (block + 1) * ID_BLOCK_SIZE
+
+        with db.engine.begin() as conn:
+            max_id = conn.execute(db.select(db.func.max(Url.id))).scalar() or 0
+            if conn.dialect.name == "sqlite":
+                # urls is an AUTOINCREMENT table, sqlite_sequence keeps the largest id of deleted rows too
+                used = conn.execute(db.text("SELECT seq FROM sqlite_sequence WHERE name = 'urls'")).scalar()
+                max_id = max(max_id, used or 0)
+        start = max(max_id + 1, self._block_end or 0)
+        return start, start + 1
+
+    def next_id(self):
+        """Return an url id that has never been handed out before"""
+
+        with self._lock:
+            if self._next_id is None or self._next_id >= self._block_end:
+                self._next_id, self._block_end = self._reserve()
+            url_id = self._next_id
+            self._next_id += 1
+            return url_id
+
+    def encode(self, url_id):
+        return self.hashids.encode(url_id)
+
+    def decode(self, code):
+        """Return the url id a code was made from or None for codes that were not made by encode()
+
+        Args:
+            code: str
+        Return: url_id: int or None
+        """
+
+        numbers = self.hashids.decode(code)
+        return numbers[0] if len(numbers) == 1 else None
+
+    def assign(self, url):
+        """Give a new url its id and short code
+
+        Args:
+            url: Url
+        Return: url
+        """
+
+        url.id = self.next_id()
+        url.uuid = self.encode(url.id)
+        return url
+
+
+code_allocator = CodeAllocator()
@@ -1,7 +1,8 @@
 import os
+import tempfile
 from datetime import timedelta
 
-from decouple import config
+from decouple import Csv, config
 
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 PARENT_DIR = os.path.abspath(os.path.join(BASE_DIR, os.pardir))
@@ -23,7 +24,71 @@ class Config:
     ALGORITHM = config("ALGORITHM")
     ACCESS_TOKEN_EXPIRES_MINUTES = config("ACCESS_TOKEN_EXPIRES_MINUTES")
     DEFAULT_DOMAIN = config("DEFAULT_DOMAIN")
-    CACHE_DEFAULT_TIMEOUT = config("CACHE_DEFAULT_TIMEOUT")
+    CACHE_TYPE = "api.tiered_cache.TieredCache"
+    CACHE_L2_TYPE = config("CACHE_L2_TYPE", default="flask_caching.backends.RedisCache")
+    CACHE_REDIS_URL = config("CACHE_REDIS_URL", default="redis://localhost:6379/0")
+    CACHE_DEFAULT_TIMEOUT = config("CACHE_DEFAULT_TIMEOUT", default=300, cast=int)
+    CACHE_L1_SIZE = config("CACHE_L1_SIZE", default=1024, cast=int)
+    CACHE_L1_TIMEOUT = config("CACHE_L1_TIMEOUT", default=5, cast=float)
+    # per-user response cache versions and profiles must be current in every worker,
+    # resolution entries have their own LRU
+    CACHE_L1_SKIP_PREFIXES = config(
+        "CACHE_L1_SKIP_PREFIXES", default="user-version/,user-profile/,resolve/", cast=Csv(post_process=tuple)
+    )
+    RATELIMIT_STORAGE_URI = config("RATELIMIT_STORAGE_URI", default="redis://localhost:6379/1")
+    RATELIMIT_STRATEGY = config("RATELIMIT_STRATEGY", default="moving-window")
+    RATELIMIT_IN_MEMORY_FALLBACK_ENABLED = config("RATELIMIT_IN_MEMORY_FALLBACK_ENABLED", default=True, cast=bool)
+    RATELIMIT_LEASE_SIZE = config("RATELIMIT_LEASE_SIZE", default=5, cast=int)
+    RATELIMIT_LEASE_TIMEOUT = config("RATELIMIT_LEASE_TIMEOUT", default=1, cast=float)
+    RATELIMIT_LEASE_MAX_ENTRIES = config("RATELIMIT_LEASE_MAX_ENTRIES", default=10000, cast=int)
+    REDIRECT_FAST_PATH = config("REDIRECT_FAST_PATH", default=True, cast=bool)
+    ASYNC_DATABASE_URL = config("ASYNC_DATABASE_URL", default="")
+    ASYNC_DB_POOL_SIZE = config("ASYNC_DB_POOL_SIZE", default=20, cast=int)
+    ASYNC_DB_MAX_OVERFLOW = config("ASYNC_DB_MAX_OVERFLOW", default=100, cast=int)
+    USER_CONTEXT_TIMEOUT = config("USER_CONTEXT_TIMEOUT", default=300, cast=int)
+    PASSWORD_HASH_METHOD = config("PASSWORD_HASH_METHOD", default="pbkdf2:sha256")
+    PASSWORD_HASH_ITERATIONS = config("PASSWORD_HASH_ITERATIONS", default=260000, cast=int)
+    PASSWORD_HASH_WORKERS = config("PASSWORD_HASH_WORKERS", default=2, cast=int)
+    PASSWORD_HASH_MAX_PENDING = config("PASSWORD_HASH_MAX_PENDING", default=64, cast=int)
+    MAIL_SERVER = config("MAIL_SERVER", default="smtp.gmail.com")
+    MAIL_PORT = config("MAIL_PORT", default=465, cast=int)
+    MAIL_USE_SSL = config("MAIL_USE_SSL", default=True, cast=bool)
+    MAIL_USE_TLS = config("MAIL_USE_TLS", default=False, cast=bool)
+    MAIL_USERNAME = config("EMAIL_SENDER", default="")
+    MAIL_PASSWORD = config("EMAIL_PASSWORD", default="")
+    MAIL_DEFAULT_SENDER = config("MAIL_DEFAULT_SENDER", default=MAIL_USERNAME)
+    MAIL_TIMEOUT = config("MAIL_TIMEOUT", default=30, cast=float)
+    MAIL_SEND_INTERVAL = config("MAIL_SEND_INTERVAL", default=5, cast=float)
+    MAIL_BATCH_SIZE = config("MAIL_BATCH_SIZE", default=50, cast=int)
+    MAIL_MAX_ATTEMPTS = config("MAIL_MAX_ATTEMPTS", default=5, cast=int)
+    MAIL_RETRY_BACKOFF = config("MAIL_RETRY_BACKOFF", default=30, cast=int)
+    MAIL_MAX_BACKOFF = config("MAIL_MAX_BACKOFF", default=3600, cast=int)
+    RESOLUTION_CACHE_SIZE = config("RESOLUTION_CACHE_SIZE", default=10000, cast=int)
+    RESOLUTION_CACHE_TIMEOUT = config("RESOLUTION_CACHE_TIMEOUT", default=300, cast=int)
+    RESOLUTION_CACHE_LOCAL_TIMEOUT = config("RESOLUTION_CACHE_LOCAL_TIMEOUT", default=5, cast=float)
+    RESOLUTION_CACHE_STALE_TIMEOUT = config("RESOLUTION_CACHE_STALE_TIMEOUT", default=5, cast=float)
+    RESOLUTION_CACHE_SHARED = config("RESOLUTION_CACHE_SHARED", default=False, cast=bool)
+    CODE_FILTER_CAPACITY = config("CODE_FILTER_CAPACITY", default=100000, cast=int)
+    CODE_FILTER_ERROR_RATE = config("CODE_FILTER_ERROR_RATE", default=0.001, cast=float)
+    CODE_FILTER_REBUILD_INTERVAL = config("CODE_FILTER_REBUILD_INTERVAL", default=3600, cast=int)
+    DOMAIN_REGISTRY_TTL = config("DOMAIN_REGISTRY_TTL", default=300, cast=int)
+    CLICK_FLUSH_SIZE = config("CLICK_FLUSH_SIZE", default=500, cast=int)
+    CLICK_FLUSH_INTERVAL = config("CLICK_FLUSH_INTERVAL", default=5, cast=float)
+    SHORT_CODE_SALT = config("SHORT_CODE_SALT", default="scissor")
+    SHORTEN_BATCH_MAX_SIZE = config("SHORTEN_BATCH_MAX_SIZE", default=1000, cast=int)
+    EXPORT_CHUNK_SIZE = config("EXPORT_CHUNK_SIZE", default=500, cast=int)
+    IMPORT_BATCH_SIZE = config("IMPORT_BATCH_SIZE", default=500, cast=int)
+    QR_RENDER_WORKERS = config("QR_RENDER_WORKERS", default=2, cast=int)
+    QR_CACHE_SIZE = config("QR_CACHE_SIZE", default=1024, cast=int)
+    QR_MAX_SIZE = config("QR_MAX_SIZE", default=2048, cast=int)
+    QR_ZIP_WINDOW = config("QR_ZIP_WINDOW", default=64, cast=int)
+    QR_CACHE_DIRECTORY = config("QR_CACHE_DIRECTORY", default=QR_CODE_DIRECTORY)
+    QR_CACHE_MAX_FILES = config("QR_CACHE_MAX_FILES", default=50000, cast=int)
+    QR_CODE_PUBLIC_DIRECTORY = config(
+        "QR_CODE_PUBLIC_DIRECTORY", default=os.path.join(PARENT_DIR, "frontend", "public", "qr_codes")
+    )
+    URLS_PAGE_SIZE = config("URLS_PAGE_SIZE", default=100, cast=int)
+    URLS_MAX_PAGE_SIZE = config("URLS_MAX_PAGE_SIZE", default=1000, cast=int)
 
 
 class DevConfig(Config):
@@ -38,6 +103,21 @@ class TestConfig(Config):
     SQLALCHEMY_DATABASE_URI = "sqlite:///"
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SQLALCHEMY_ECHO = False
+    RESOLUTION_CACHE_SHARED = False
+    CACHE_L2_TYPE = "flask_caching.backends.SimpleCache"
+    RATELIMIT_STORAGE_URI = "memory://"
+    CLICK_FLUSH_INTERVAL = 0
+    CODE_FILTER_REBUILD_INTERVAL = 0
+    QR_RENDER_WORKERS = 0
+    PASSWORD_HASH_WORKERS = 0
+    PASSWORD_HASH_ITERATIONS = 1000
+    MAIL_SEND_INTERVAL = 0
+    MAIL_SERVER = "localhost"
+    MAIL_USE_SSL = False
+    MAIL_USERNAME = ""
+    MAIL_DEFAULT_SENDER = "noreply@scissor.test"
+    QR_CACHE_DIRECTORY = os.path.join(tempfile.gettempdir(), "scissor", "qr_cache")
+    QR_CODE_PUBLIC_DIRECTORY = os.path.join(tempfile.gettempdir(), "scissor", "qr_codes")
 
 
 class ProdConfig(Config):
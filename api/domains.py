@@ -0,0 +1,121 @@
+import threading
+import time
+from urllib.parse import urlparse
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from api.models import User
+from api.utils import db
+
+
+class DomainRegistry:
+    """In-memory registry of custom domains answering "is this host ours and whose is it"
+
+    The registry is loaded once at startup and reloaded every `ttl` seconds so
+    domains changed by other workers are picked up. Hosts that are not in the
+    registry fall back to an indexed lookup on users.custom_domain.
+    """
+
+    def __init__(self, ttl=300, max_misses=10000):
+        self.ttl = ttl
+        self.max_misses = max_misses
+        self._owners = {}
+        self._hosts = {}
+        self._misses = set()
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.ttl = app.config.get("DOMAIN_REGISTRY_TTL", self.ttl)
+        with self._lock:
+            self._owners.clear()
+            self._hosts.clear()
+            self._misses.clear()
+            self._loaded_at = None
+        with app.app_context():
+            try:
+                self.load()
+            except SQLAlchemyError:
+                # the tables may not exist yet, the first lookup will load the registry
+                db.session.rollback()
+        app.extensions["domain_registry"] = self
+
+    @staticmethod
+    def host_of(custom_domain):
+        """Return the host part of a stored custom domain eg. https://example.com/ -> example.com
+
+        Args:
+            custom_domain: str
+        Return: host: str or None
+        """
+
+        if not custom_domain:
+            return None
+        return urlparse(custom_domain).netloc or custom_domain.strip("/")
+
+    def load(self):
+        """Load every custom domain from the users table"""
+
+        rows = db.session.query(User.id, User.custom_domain).filter(User.custom_domain.isnot(None)).all()
+        owners, hosts = {}, {}
+        for user_id, custom_domain in rows:
+            host = self.host_of(custom_domain)
+            if host:
+                owners[host] = user_id
+                hosts[user_id] = host
+        with self._lock:
+            self._owners = owners
+            self._hosts = hosts
+            self._misses = set()
+            self._loaded_at = time.monotonic()
+
+    def _is_stale(self):
+        return self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl
+
+    def lookup(self, host):
+        """Return the id of the user owning a host or None if the host is not a custom domain
+
+        Args:
+            host: str
+        Return: user_id: int or None
+        """
+
+        if self._is_stale():
+            self.load()
+
+        user_id = self._owners.get(host)
+        if user_id is not None or host in self._misses:
+            return user_id
+
+        candidates = [host, f"http://{host}/", f"https://{host}/"]
+        row = db.session.query(User.id).filter(User.custom_domain.in_(candidates)).first()
+        with self._lock:
+            if row is None:
+                if len(self._misses) >= self.max_misses:
+                    self._misses.clear()
+                self._misses.add(host)
+                return None
+            self._owners[host] = row.id
+            self._hosts[row.id] = host
+        return row.id
+
+    def set_owner(self, user_id, custom_domain):
+        """Record a changed or removed custom domain of a user
+
+        Args:
+            user_id: int
+            custom_domain: str or None, empty when the domain was removed
+        """
+
+        host = self.host_of(custom_domain)
+        with self._lock:
+            old_host = self._hosts.pop(user_id, None)
+            if old_host is not None and self._owners.get(old_host) == user_id:
+                del self._owners[old_host]
+            if host:
+                self._owners[host] = user_id
+                self._hosts[user_id] = host
+                self._misses.discard(host)
+
+
+domain_registry = DomainRegistry()
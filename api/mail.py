@@ -0,0 +1,226 @@
+import smtplib
+import ssl
+import threading
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+
+from decouple import config
+
+from api.models import MailMessage
+from api.utils import db
+
+DEFAULT_DOMAIN = config("DEFAULT_DOMAIN")
+
+
+class MailSender:
+    """Delivers the messages of the mail outbox in the background
+
+    Requests only insert a row in the outbox. A background thread wakes up
+    every `send_interval` seconds, or as soon as a message is queued, and
+    sends the due messages in batches of `batch_size` over one SMTP
+    connection that stays open between batches. A message that fails is
+    retried after a backoff doubling from `retry_backoff` seconds up to
+    `max_backoff`, and is marked failed after `max_attempts` attempts.
+
+    Claimed messages are pushed `claim_timeout` seconds into the future
+    before they are sent, so other workers skip them and they become due
+    again if this process dies while sending. With a send interval of 0 no
+    thread is started and messages are only sent by send_pending().
+    """
+
+    def __init__(self, send_interval=5, batch_size=50, max_attempts=5, retry_backoff=30, max_backoff=3600,
+                 claim_timeout=300):
+        self.send_interval = send_interval
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.max_backoff = max_backoff
+        self.claim_timeout = claim_timeout
+        self.app = None
+        self._server = None
+        self._send_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.send_interval = app.config.get("MAIL_SEND_INTERVAL", self.send_interval)
+        self.batch_size = app.config.get("MAIL_BATCH_SIZE", self.batch_size)
+        self.max_attempts = app.config.get("MAIL_MAX_ATTEMPTS", self.max_attempts)
+        self.retry_backoff = app.config.get("MAIL_RETRY_BACKOFF", self.retry_backoff)
+        self.max_backoff = app.config.get("MAIL_MAX_BACKOFF", self.max_backoff)
+        self.app = app
+        self.close()
+        app.extensions["mail_sender"] = self
+
+    def enqueue(self, recipient, subject, body):
+        """Queue a message in the outbox, it is sent in the background
+
+        Args:
+            recipient: str
+            subject: str
+            body: str
+        Return: MailMessage
+        """
+
+        message = MailMessage(recipient=recipient, subject=subject, body=body)
+        message.save()
+        if self.send_interval > 0:
+            self._ensure_thread()
+            self._wakeup.set()
+        return message
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="mail-sender", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.send_interval)
+            self._wakeup.clear()
+            try:
+                self.send_pending()
+            except Exception:
+                self.app.logger.exception("Failed to send queued mail")
+
+    def _connect(self):
+        settings = self.app.config
+        host, port, timeout = settings["MAIL_SERVER"], settings["MAIL_PORT"], settings.get("MAIL_TIMEOUT", 30)
+        if settings.get("MAIL_USE_SSL", True):
+            server = smtplib.SMTP_SSL(host, port, context=ssl.create_default_context(), timeout=timeout)
+        else:
+            server = smtplib.SMTP(host, port, timeout=timeout)
+            if settings.get("MAIL_USE_TLS", False):
+                server.starttls(context=ssl.create_default_context())
+        if settings.get("MAIL_USERNAME"):
+            server.login(settings["MAIL_USERNAME"], settings["MAIL_PASSWORD"])
+        return server
+
+    def _connection(self):
+        """Return the open SMTP connection, reconnecting when the server dropped it"""
+
+        if self._server is not None:
+            try:
+                if self._server.noop()[0] == 250:
+                    return self._server
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.close()
+        self._server = self._connect()
+        return self._server
+
+    def close(self):
+        server, self._server = self._server, None
+        if server is not None:
+            try:
+                server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+
+    def _claim(self):
+        now = datetime.utcnow()
+        messages = (
+            MailMessage.query.filter(MailMessage.status == "pending", MailMessage.next_attempt_at <= now)
+            .order_by(MailMessage.id)
+            .limit(self.batch_size)
+            .with_for_update(skip_locked=True)
+            .all()
+        )
+        for message in messages:
+            message.next_attempt_at = now + timedelta(seconds=self.claim_timeout)
+        db.session.commit()
+        return messages
+
+    def _retry_later(self, message, error):
+        message.attempts += 1
+        message.last_error = str(error)[:1000]
+        if message.attempts >= self.max_attempts:
+            message.status = "failed"
+            return
+        backoff = min(self.retry_backoff * 2 ** (message.attempts - 1), self.max_backoff)
+        message.next_attempt_at = datetime.utcnow() + timedelta(seconds=backoff)
+
+    def _send_batch(self, messages):
+        sender = self.app.config["MAIL_DEFAULT_SENDER"]
+        sent = 0
+        server = None
+        for message in messages:
+            email = EmailMessage()
+            email["Subject"] = message.subject
+            email["From"] = sender
+            email["To"] = message.recipient
+            email.set_content(message.body)
+            try:
+                if server is None:
+                    # checked once per batch, a connection dropped mid batch is reopened by the next message
+                    server = self._connection()
+                server.send_message(email)
+            except smtplib.SMTPRecipientsRefused as e:
+                message.attempts += 1
+                message.status = "failed"
+                message.last_error = str(e)[:1000]
+            except (smtplib.SMTPException, OSError) as e:
+                # the connection may be unusable, the next message opens a new one
+                self.close()
+                server = None
+                self._retry_later(message, e)
+            else:
+                message.attempts += 1
+                message.status = "sent"
+                message.sent_at = datetime.utcnow()
+                sent += 1
+        db.session.commit()
+        return sent
+
+    def send_pending(self):
+        """Send every due message of the outbox in batches over one SMTP connection
+
+        Return: the number of messages sent
+        """
+
+        if self.app is None:
+            return 0
+
+        sent = 0
+        with self._send_lock, self.app.app_context():
+            while True:
+                messages = self._claim()
+                if not messages:
+                    break
+                sent += self._send_batch(messages)
+                if len(messages) < self.batch_size:
+                    break
+        return sent
+
+
+mail_sender = MailSender()
+
+
+class MailService:
+    @staticmethod
+    def send_reset_mail(email: str, token: str, uuid: str) -> bool:
+        """Queue the password reset mail of a user
+
+        Args:
+            email: str
+            token: str
+            uuid: str
+        Return: True: Bool
+        """
+
+        subject = "Password reset"
+        body = f"""
+                We have received a request to reset your password.
+                Ignore this message if you didn't make the request or click the link below to reset your password.
+                This link is only active for 10 minutes.
+                {DEFAULT_DOMAIN}auth/password-reset/{token}/{uuid}/confirm
+
+                From the Scissor team
+            """
+
+        mail_sender.enqueue(email, subject, body)
+        return True
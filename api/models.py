@@ -1,7 +1,15 @@
+import hashlib
 from datetime import datetime
 
+from sqlalchemy.orm import validates
+
 from api.utils import db
 
+UNKNOWN_REFERRER = "Unknowns"
+
+# each value reserves a block of url ids, see api.codes
+url_id_blocks = db.Sequence("url_id_blocks", metadata=db.metadata)
+
 
 class User(db.Model):
     __tablename__ = "users"
@@ -12,7 +20,7 @@ class User(db.Model):
     email = db.Column(db.String(50), nullable=False, unique=True)
     password_hash = db.Column(db.Text(), nullable=False)
     date_joined = db.Column(db.DateTime(), default=datetime.utcnow)
-    custom_domain = db.Column(db.Text(), nullable=True)
+    custom_domain = db.Column(db.Text(), nullable=True, index=True)
     urls = db.relationship("Url", backref="url", lazy=True)
     deleted_urls = db.relationship("DeletedUrl", backref="deleted_url", lazy=True)
 
@@ -36,6 +44,7 @@ class Url(db.Model):
     id = db.Column(db.Integer(), primary_key=True)
     uuid = db.Column(db.String(10), nullable=False, unique=True)
     long_url = db.Column(db.String(1000), nullable=False, unique=False)
+    long_url_hash = db.Column(db.String(64), nullable=False)
     qr_code = db.Column(db.String(500), nullable=True, unique=True)
     title = db.Column(db.String(20), nullable=False, default='URL Title')
     has_qr_code = db.Column(db.Boolean, default=False)
@@ -43,16 +52,49 @@ class Url(db.Model):
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     clicks = db.Column(db.Integer(), default=0)
     user_id = db.Column(db.Integer(), db.ForeignKey("users.id"), nullable=False)
-    referrer = db.Column(db.Text())
+    referrer_counts = db.relationship(
+        "UrlReferrerCount", backref="url", lazy=True, cascade="all, delete-orphan", passive_deletes=True
+    )
+    hourly_clicks = db.relationship(
+        "UrlHourlyClicks", backref="url", lazy=True, cascade="all, delete-orphan", passive_deletes=True
+    )
+    daily_clicks = db.relationship(
+        "UrlDailyClicks", backref="url", lazy=True, cascade="all, delete-orphan", passive_deletes=True
+    )
+
+    __table_args__ = (
+        db.Index("ix_urls_user_id_created_at_id", "user_id", "created_at", "id"),
+        db.Index("ix_urls_user_id_long_url_hash", "user_id", "long_url_hash", unique=True),
+        # ids are never reused on SQLite, the code of a deleted url must not resolve to a new one
+        {"sqlite_autoincrement": True},
+    )
 
     def __repr__(self) -> str:
         return self.uuid
 
+    @staticmethod
+    def hash_long_url(long_url):
+        return hashlib.sha256(long_url.encode("utf-8")).hexdigest()
+
+    @validates("long_url")
+    def validate_long_url(self, key, long_url):
+        self.long_url_hash = self.hash_long_url(long_url)
+        return long_url
+
+    @classmethod
+    def get_for_user(cls, user_id, long_url):
+        """Return the url of a user shortening long_url with a point lookup on (user_id, long_url_hash)"""
+        return cls.query.filter_by(user_id=user_id, long_url_hash=cls.hash_long_url(long_url)).first()
+
     def save(self):
         db.session.add(self)
         db.session.commit()
 
     def delete(self):
+        # bulk delete the click counters instead of loading every row of the url's history,
+        # SQLite does not enforce the ON DELETE CASCADE of their foreign keys
+        for model in (UrlReferrerCount, UrlHourlyClicks, UrlDailyClicks):
+            db.session.execute(db.delete(model).where(model.url_id == self.id))
         db.session.delete(self)
         db.session.commit()
 
@@ -61,6 +103,63 @@ class Url(db.Model):
         db.session.commit()
 
 
+class UrlReferrerCount(db.Model):
+    __tablename__ = "url_referrer_counts"
+    url_id = db.Column(db.Integer(), db.ForeignKey("urls.id", ondelete="CASCADE"), primary_key=True)
+    referrer = db.Column(db.String(100), primary_key=True)
+    count = db.Column(db.Integer(), nullable=False, default=0)
+
+    def __repr__(self) -> str:
+        return f"{self.referrer}: {self.count}"
+
+    @staticmethod
+    def attach(urls, chunk_size=500):
+        """Set url.referrers to a {referrer: clicks} dict on every url
+        The counts of all the urls are read with one grouped query per chunk of urls
+
+        Args:
+            urls: list of Url
+        Return: urls
+        """
+
+        for url in urls:
+            url.referrers = {UNKNOWN_REFERRER: 0}
+        by_id = {url.id: url for url in urls}
+        ids = list(by_id)
+        for start in range(0, len(ids), chunk_size):
+            rows = (
+                db.session.query(
+                    UrlReferrerCount.url_id, UrlReferrerCount.referrer, db.func.sum(UrlReferrerCount.count)
+                )
+                .filter(UrlReferrerCount.url_id.in_(ids[start:start + chunk_size]))
+                .group_by(UrlReferrerCount.url_id, UrlReferrerCount.referrer)
+                .all()
+            )
+            for url_id, referrer, count in rows:
+                by_id[url_id].referrers[referrer] = count
+        return urls
+
+
+class UrlHourlyClicks(db.Model):
+    __tablename__ = "url_clicks_hourly"
+    url_id = db.Column(db.Integer(), db.ForeignKey("urls.id", ondelete="CASCADE"), primary_key=True)
+    bucket_start = db.Column(db.DateTime(), primary_key=True)
+    clicks = db.Column(db.Integer(), nullable=False, default=0)
+
+    def __repr__(self) -> str:
+        return f"{self.bucket_start}: {self.clicks}"
+
+
+class UrlDailyClicks(db.Model):
+    __tablename__ = "url_clicks_daily"
+    url_id = db.Column(db.Integer(), db.ForeignKey("urls.id", ondelete="CASCADE"), primary_key=True)
+    bucket_start = db.Column(db.DateTime(), primary_key=True)
+    clicks = db.Column(db.Integer(), nullable=False, default=0)
+
+    def __repr__(self) -> str:
+        return f"{self.bucket_start}: {self.clicks}"
+
+
 class DeletedUrl(db.Model):
     __tablename__ = "deleted_urls"
     id = db.Column(db.Integer(), primary_key=True)
@@ -69,6 +168,8 @@ class DeletedUrl(db.Model):
     deleted_at = db.Column(db.DateTime(), default=datetime.utcnow)
     user_id = db.Column(db.Integer(), db.ForeignKey("users.id"), nullable=False)
 
+    __table_args__ = (db.Index("ix_deleted_urls_user_id_deleted_at_id", "user_id", "deleted_at", "id"),)
+
     def __repr__(self) -> str:
         return self.long_url
 
@@ -83,3 +184,52 @@ class DeletedUrl(db.Model):
     def update(self):
         db.session.commit()
         db.session.commit()
+
+
+class QRRenderJob(db.Model):
+    __tablename__ = "qr_render_jobs"
+    id = db.Column(db.Integer(), primary_key=True)
+    user_id = db.Column(db.Integer(), db.ForeignKey("users.id"), nullable=False, index=True)
+    status = db.Column(db.String(20), nullable=False, default="pending")
+    total = db.Column(db.Integer(), nullable=False, default=0)
+    done = db.Column(db.Integer(), nullable=False, default=0)
+    error = db.Column(db.Text(), nullable=True)
+    created_at = db.Column(db.DateTime(), default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime(), nullable=True)
+
+    def __repr__(self) -> str:
+        return f"{self.id}: {self.status}"
+
+    def save(self):
+        db.session.add(self)
+        db.session.commit()
+
+    def update(self):
+        db.session.commit()
+
+    def is_superseded(self):
+        """A newer job of the same user makes this one obsolete"""
+        newer = QRRenderJob.query.filter(QRRenderJob.user_id == self.user_id, QRRenderJob.id > self.id)
+        return db.session.query(newer.exists()).scalar()
+
+
+class MailMessage(db.Model):
+    __tablename__ = "mail_outbox"
+    __table_args__ = (db.Index("ix_mail_outbox_status_next_attempt_at", "status", "next_attempt_at"),)
+    id = db.Column(db.Integer(), primary_key=True)
+    recipient = db.Column(db.String(254), nullable=False)
+    subject = db.Column(db.String(200), nullable=False)
+    body = db.Column(db.Text(), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default="pending")
+    attempts = db.Column(db.Integer(), nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime(), nullable=False, default=datetime.utcnow)
+    last_error = db.Column(db.Text(), nullable=True)
+    created_at = db.Column(db.DateTime(), default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime(), nullable=True)
+
+    def __repr__(self) -> str:
+        return f"{self.id}: {self.recipient} {self.status}"
+
+    def save(self):
+        db.session.add(self)
+        db.session.commit()
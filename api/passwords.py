@@ -0,0 +1,118 @@
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+from flask.cli import AppGroup
+from werkzeug.security import check_password_hash, generate_password_hash
+
+passwords_cli = AppGroup("passwords", help="Password hashing tools.")
+
+
+class PasswordHasher:
+    """Hashes and checks passwords in a bounded pool of worker processes
+
+    Hashing is deliberately CPU heavy, running it in other processes keeps a
+    burst of logins from holding the GIL of the worker serving redirects. At
+    most `max_pending` hashes are queued, further callers wait for a slot.
+    With 0 workers hashes are computed inline in the calling thread.
+
+    Configured with:
+        PASSWORD_HASH_METHOD: werkzeug hash method, eg. pbkdf2:sha256
+        PASSWORD_HASH_ITERATIONS: iterations of pbkdf2 methods
+        PASSWORD_HASH_WORKERS: processes in the pool
+        PASSWORD_HASH_MAX_PENDING: hashes queued or running at once
+    """
+
+    def __init__(self, method="pbkdf2:sha256", iterations=260000, workers=2, max_pending=64):
+        self.method = method
+        self.iterations = iterations
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor = None
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.method = app.config.get("PASSWORD_HASH_METHOD", self.method)
+        self.iterations = app.config.get("PASSWORD_HASH_ITERATIONS", self.iterations)
+        self.workers = app.config.get("PASSWORD_HASH_WORKERS", self.workers)
+        self.max_pending = app.config.get("PASSWORD_HASH_MAX_PENDING", self.max_pending)
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        app.extensions["password_hasher"] = self
+
+    @property
+    def method_string(self):
+        """The method argument of generate_password_hash eg. pbkdf2:sha256:260000"""
+
+        if self.method.startswith("pbkdf2"):
+            return f"{self.method}:{self.iterations}"
+        return self.method
+
+    def _run(self, fn, *args):
+        if self.workers <= 0:
+            return fn(*args)
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        with self._slots:
+            return self._executor.submit(fn, *args).result()
+
+    def hash(self, password):
+        """Hash a password with the configured method
+
+        Args:
+            password: str
+        Return: password_hash: str
+        """
+
+        return self._run(generate_password_hash, password, self.method_string)
+
+    def check(self, password_hash, password):
+        """Check a password against a stored hash, whatever method made the hash
+
+        Args:
+            password_hash: str
+            password: str
+        Return: bool
+        """
+
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """Return True when a stored hash was not made with the configured method and iterations"""
+
+        return password_hash.split("$", 1)[0] != self.method_string
+
+
+password_hasher = PasswordHasher()
+
+
+@passwords_cli.command("benchmark")
+@click.option("--logins", default=200, show_default=True, help="Number of password checks to run.")
+def benchmark(logins):
+    """Report how many logins per second and per core the configured hashing sustains"""
+
+    password = "benchmark password"
+    password_hash = generate_password_hash(password, password_hasher.method_string)
+    workers = password_hasher.workers
+
+    if workers > 0:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # start every worker process before timing
+            list(executor.map(check_password_hash, [password_hash] * workers, [password] * workers))
+            started = time.perf_counter()
+            list(executor.map(check_password_hash, [password_hash] * logins, [password] * logins))
+            elapsed = time.perf_counter() - started
+    else:
+        started = time.perf_counter()
+        for _ in range(logins):
+            check_password_hash(password_hash, password)
+        elapsed = time.perf_counter() - started
+
+    per_second = logins / elapsed
+    click.echo(f"method: {password_hasher.method_string}")
+    click.echo(f"workers: {workers} ({os.cpu_count()} cores)")
+    click.echo(f"logins per second: {per_second:.1f}")
+    click.echo(f"logins per second per core: {per_second / max(workers, 1):.1f}")
@@ -0,0 +1,482 @@
+import bisect
+import hashlib
+import heapq
+import io
+import os
+import re
+import threading
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from datetime import datetime
+
+import png
+import qrcode
+
+from api.models import QRRenderJob, Url
+from api.utils import db, write_file
+
+
+# pixels per module when no size is requested, the size qrcode.make renders
+DEFAULT_BOX_SIZE = 10
+# widths a requested size is rounded down to, every size between two of them gives one cached image
+QR_SIZES = (64, 128, 256, 512, 1024, 2048, 4096)
+# names of the image files of the cache directory, sha256 of the payload - size . format
+CACHE_FILE = re.compile(r"[0-9a-f]{64}-\w+\.\w+")
+
+
+def snap_size(size):
+    """Round a requested width down to one of QR_SIZES, None stays None for the default size"""
+
+    if not size:
+        return None
+    return QR_SIZES[max(bisect.bisect_right(QR_SIZES, size) - 1, 0)]
+
+
+def render_qr_matrix(payload):
+    """Encode a payload into the module matrix of a QR code, runs in the worker processes
+
+    Args:
+        payload: str
+    Return: list of rows of booleans, True for dark modules, quiet zone included
+    """
+
+    qr = qrcode.QRCode()
+    qr.add_data(payload)
+    return qr.get_matrix()
+
+
+def box_size(matrix, size):
+    return max(1, size // len(matrix)) if size else DEFAULT_BOX_SIZE
+
+
+def rasterise_png(matrix, size=None):
+    """Draw a module matrix as a black and white PNG at most `size` pixels wide
+
+    Args:
+        matrix: list of rows of booleans
+        size: int or None
+    Return: PNG bytes
+    """
+
+    scale = box_size(matrix, size)
+    width = len(matrix) * scale
+    rows = []
+    for modules in matrix:
+        row = [pixel for module in modules for pixel in [0 if module else 1] * scale]
+        rows.extend([row] * scale)
+    buffer = io.BytesIO()
+    png.Writer(width, width, greyscale=True, bitdepth=1).write(buffer, rows)
+    return buffer.getvalue()
+
+
+def rasterise_svg(matrix, size=None):
+    """Draw a module matrix as an SVG with one path for the dark modules
+
+    Args:
+        matrix: list of rows of booleans
+        size: int or None
+    Return: SVG bytes
+    """
+
+    modules = len(matrix)
+    width = modules * box_size(matrix, size)
+    path = "".join(
+        f"M{x},{y}h1v1h-1z" for y, row in enumerate(matrix) for x, module in enumerate(row) if module
+    )
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{width}" '
+        f'viewBox="0 0 {modules} {modules}" shape-rendering="crispEdges">'
+        f'<rect width="100%" height="100%" fill="#fff"/><path d="{path}" fill="#000"/></svg>'
+    ).encode("utf-8")
+
+
+# format: (mimetype, rasterise function)
+QR_FORMATS = {
+    "png": ("image/png", rasterise_png),
+    "svg": ("image/svg+xml", rasterise_svg),
+}
+
+
+def qr_payload(domain, uuid):
+    return f"{domain}{uuid}?referrer=qr"
+
+
+class QRService:
+    """Encodes QR codes in a pool of worker processes
+
+    Renders of the same payload that are in flight at the same time share one
+    future. Re-rendering every QR code of a user after a domain change runs as
+    a background job whose progress is stored in a QRRenderJob row. With 0
+    workers renders and jobs run inline in the calling thread.
+    """
+
+    def __init__(self, workers=2, job_window=64):
+        self.workers = workers
+        self.job_window = job_window
+        self.app = None
+        self._executor = None
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.workers = app.config.get("QR_RENDER_WORKERS", self.workers)
+        self.app = app
+        with self._lock:
+            self._in_flight.clear()
+        app.extensions["qr_service"] = self
+
+    def _submit(self, fn, *args):
+        if self.workers <= 0:
+            future = Future()
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor.submit(fn, *args)
+
+    def _forget(self, payload, future):
+        with self._lock:
+            if self._in_flight.get(payload) is future:
+                del self._in_flight[payload]
+
+    def render(self, payload):
+        """Encode a payload into a module matrix, sharing the work with identical renders in flight
+
+        Args:
+            payload: str
+        Return: Future of the matrix
+        """
+
+        with self._lock:
+            future = self._in_flight.get(payload)
+            if future is not None:
+                return future
+            future = self._submit(render_qr_matrix, payload)
+            self._in_flight[payload] = future
+        # a finished future runs the callback right away, so it must be added outside the lock
+        future.add_done_callback(lambda done: self._forget(payload, done))
+        return future
+
+    def start_domain_job(self, user_id, base_url):
+        """Re-render every QR code of a user for a new domain in the background
+
+        Args:
+            user_id: int
+            base_url: the protocol + domain eg. https://example.com/
+        Return: QRRenderJob or None if the user has no QR codes
+        """
+
+        query = Url.query.filter(Url.user_id == user_id, Url.qr_code.isnot(None))
+        if query.first() is None:
+            return None
+
+        job = QRRenderJob(user_id=user_id, total=query.count())
+        job.save()
+
+        if self.workers <= 0:
+            self._run(job.id, base_url)
+        else:
+            thread = threading.Thread(target=self._run_in_app, args=(job.id, base_url), daemon=True)
+            thread.start()
+        return job
+
+    def _run_in_app(self, job_id, base_url):
+        with self.app.app_context():
+            self._run(job_id, base_url)
+
+    def _run(self, job_id, base_url):
+        try:
+            self.run_domain_job(job_id, base_url)
+        except Exception:
+            self.app.logger.exception("QR render job %s failed", job_id)
+
+    def run_domain_job(self, job_id, base_url):
+        job = db.session.get(QRRenderJob, job_id)
+        job.status = "running"
+        job.update()
+
+        try:
+            last_id = 0
+            while True:
+                rows = db.session.execute(
+                    db.select(Url.id, Url.uuid, Url.qr_code)
+                    .where(Url.user_id == job.user_id, Url.qr_code.isnot(None), Url.id > last_id)
+                    .order_by(Url.id)
+                    .limit(self.job_window)
+                ).all()
+                if not rows:
+                    break
+                if job.is_superseded():
+                    job.status = "superseded"
+                    break
+                # links whose QR code file was removed are skipped like they always were
+                rows_to_render = [(uuid, file_path) for _, uuid, file_path in rows if os.path.exists(file_path)]
+                images = qr_cache.get_many([qr_payload(base_url, uuid) for uuid, _ in rows_to_render])
+                for (_, file_path), (_, image) in zip(rows_to_render, images):
+                    write_file(file_path, image)
+                last_id = rows[-1].id
+                job.done += len(rows)
+                job.update()
+            if job.status == "running":
+                job.status = "done"
+        except Exception as e:
+            db.session.rollback()
+            job.status = "failed"
+            job.error = str(e)
+            raise
+        finally:
+            job.finished_at = datetime.utcnow()
+            job.update()
+
+
+qr_service = QRService()
+
+
+def file_mtime(entry):
+    try:
+        return entry.stat().st_mtime
+    except FileNotFoundError:
+        return 0
+
+
+class QRCache:
+    """Content addressed cache of rendered QR codes
+
+    The module matrix of a payload is encoded once and kept in memory, every
+    format and size is a rasterisation of that matrix. Images are keyed by the
+    sha256 of their payload plus the format and size, which is also their
+    strong ETag. Lookups go through a bounded in-memory LRU of image bytes,
+    then the files in `directory` shared by every worker, and only encode a
+    payload when neither has it. Requested sizes are rounded down to one of
+    QR_SIZES so a payload has a handful of images, and once the directory
+    holds more than `max_files` images the oldest are removed.
+    """
+
+    def __init__(self, maxsize=1024, directory=None, max_files=50000):
+        self.maxsize = maxsize
+        self.directory = directory
+        self.max_files = max_files
+        self._files = 0
+        self._prune_lock = threading.Lock()
+        self.pruned = 0
+        self._images = OrderedDict()
+        self._matrices = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.renders = 0
+        self.rasterisations = 0
+
+    def init_app(self, app):
+        self.maxsize = app.config.get("QR_CACHE_SIZE", self.maxsize)
+        self.directory = app.config.get("QR_CACHE_DIRECTORY", self.directory)
+        self.max_files = app.config.get("QR_CACHE_MAX_FILES", self.max_files)
+        os.makedirs(self.directory, exist_ok=True)
+        self.clear()
+        self._files = len(self._cached_files())
+        app.extensions["qr_cache"] = self
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+            self._matrices.clear()
+            self.hits = self.disk_hits = self.renders = self.rasterisations = self.pruned = 0
+
+    @staticmethod
+    def key(payload, fmt="png", size=None):
+        digest = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+        return f"{digest}-{snap_size(size) or 'default'}.{fmt}"
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def _get_memory(self, entries, key):
+        with self._lock:
+            value = entries.get(key)
+            if value is not None:
+                entries.move_to_end(key)
+            return value
+
+    def _set_memory(self, entries, key, value):
+        with self._lock:
+            entries[key] = value
+            entries.move_to_end(key)
+            while len(entries) > self.maxsize:
+                entries.popitem(last=False)
+
+    def _read_disk(self, key):
+        try:
+            with open(self.path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _cached_files(self):
+        with os.scandir(self.directory) as entries:
+            return [entry for entry in entries if CACHE_FILE.fullmatch(entry.name)]
+
+    def _write_disk(self, key, image):
+        write_file(self.path(key), image)
+        with self._lock:
+            self._files += 1
+            full = self.max_files and self._files > self.max_files
+        if full:
+            self.prune()
+
+    def prune(self):
+        """Remove the oldest images once the directory holds more than max_files, down to 90% of it
+
+        Other workers share the directory, it is counted again before removing anything
+
+        Return: the number of files removed
+        """
+
+        if not self._prune_lock.acquire(blocking=False):
+            return 0
+        try:
+            files = self._cached_files()
+            excess = len(files) - int(self.max_files * 0.9)
+            removed = 0
+            if excess > 0:
+                for entry in heapq.nsmallest(excess, files, key=file_mtime):
+                    try:
+                        os.remove(entry.path)
+                        removed += 1
+                    except FileNotFoundError:
+                        pass
+            with self._lock:
+                self._files = len(files) - removed
+                self.pruned += removed
+            return removed
+        finally:
+            self._prune_lock.release()
+
+    def get_many(self, payloads, fmt="png", size=None):
+        """Return the key and image of every payload, encoding the missing ones in parallel
+
+        Args:
+            payloads: list of str
+            fmt: one of QR_FORMATS
+            size: width in pixels, rounded down to one of QR_SIZES, or None for 10 pixels per module
+        Return: list of (key, image bytes) in the order of payloads
+        """
+
+        size = snap_size(size)
+        keys = [self.key(payload, fmt, size) for payload in payloads]
+        images, pending = {}, {}
+        for payload, key in zip(payloads, keys):
+            if key in images or key in pending:
+                continue
+            image = self._get_memory(self._images, key)
+            if image is not None:
+                self.hits += 1
+            else:
+                image = self._read_disk(key)
+                if image is not None:
+                    self.disk_hits += 1
+                    self._set_memory(self._images, key, image)
+            if image is not None:
+                images[key] = image
+                continue
+            matrix_key = self.key(payload, "matrix")
+            matrix = self._get_memory(self._matrices, matrix_key)
+            if matrix is None:
+                future = qr_service.render(payload)
+            else:
+                future = Future()
+                future.set_result(matrix)
+            pending[key] = (matrix_key, future)
+
+        for key, (matrix_key, future) in pending.items():
+            matrix = self._get_memory(self._matrices, matrix_key)
+            if matrix is None:
+                matrix = future.result()
+                self.renders += 1
+                self._set_memory(self._matrices, matrix_key, matrix)
+            image = QR_FORMATS[fmt][1](matrix, size)
+            self.rasterisations += 1
+            self._write_disk(key, image)
+            self._set_memory(self._images, key, image)
+            images[key] = image
+        return [(key, images[key]) for key in keys]
+
+    def get(self, payload, fmt="png", size=None):
+        return self.get_many([payload], fmt, size)[0]
+
+    def stats(self):
+        return {
+            "size": len(self._images),
+            "matrices": len(self._matrices),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "renders": self.renders,
+            "rasterisations": self.rasterisations,
+            "files": self._files,
+            "max_files": self.max_files,
+            "pruned": self.pruned,
+        }
+
+
+qr_cache = QRCache()
+
+
+class ZipStream(io.RawIOBase):
+    """Write-only file that hands what was written so far to a streamed response"""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def zip_qr_codes(user_id, domain, fmt="png", size=None, window=64):
+    """Yield a ZIP archive of the QR codes of every url of a user while it is written
+
+    Urls are read `window` at a time by keyset on their id, the missing QR codes
+    of a window are rendered in parallel and the window is sent before the next
+    one is read, so memory does not grow with the number of urls.
+
+    Args:
+        user_id: int
+        domain: the protocol + domain eg. https://example.com/
+        fmt: one of QR_FORMATS
+        size: width in pixels or None
+        window: int
+    Yields: bytes of the archive
+    """
+
+    stream = ZipStream()
+    # QR codes are already compressed
+    with zipfile.ZipFile(stream, "w", zipfile.ZIP_STORED) as archive:
+        last_id = 0
+        while True:
+            rows = db.session.execute(
+                db.select(Url.id, Url.uuid)
+                .where(Url.user_id == user_id, Url.id > last_id)
+                .order_by(Url.id)
+                .limit(window)
+            ).all()
+            if not rows:
+                break
+            images = qr_cache.get_many([qr_payload(domain, row.uuid) for row in rows], fmt, size)
+            for row, (_, image) in zip(rows, images):
+                archive.writestr(f"{row.uuid}_qrcode.{fmt}", image)
+            last_id = rows[-1].id
+            yield stream.drain()
+    yield stream.drain()
@@ -0,0 +1,137 @@
+import threading
+import time
+from collections import OrderedDict
+
+from flask import request
+from flask_limiter.util import get_remote_address
+from limits import parse
+
+from api.utils import limiter
+
+
+class RateLimitLeases:
+    """Answers most rate limit checks of a worker from a local lease of hits
+
+    The limiter storage is shared by every worker so its moving windows are
+    exact cluster-wide, but checking one costs a round trip per request.
+    Instead, when a worker has no lease left for a client on an endpoint it
+    takes `lease_size` hits from the shared window at once and spends them
+    locally for at most `lease_timeout` seconds. When a whole lease cannot be
+    taken the request is left to the ordinary single hit check of the limiter,
+    so a client close to its limit is counted exactly. Hits leased but not
+    spent still count against the client, a limit can be reached up to
+    lease_size - 1 requests early per worker.
+
+    Configured with:
+        RATELIMIT_LEASE_SIZE: hits taken from the shared window at once, 1 disables leasing
+        RATELIMIT_LEASE_TIMEOUT: seconds a lease can be spent
+        RATELIMIT_LEASE_MAX_ENTRIES: leases kept per worker
+    """
+
+    def __init__(self, lease_size=5, lease_timeout=1.0, max_entries=10000):
+        self.lease_size = lease_size
+        self.lease_timeout = lease_timeout
+        self.max_entries = max_entries
+        self._leases = OrderedDict()
+        self._limits = {}
+        self._lock = threading.Lock()
+        self.local_hits = 0
+        self.leased = 0
+
+    def init_app(self, app):
+        self.lease_size = app.config.get("RATELIMIT_LEASE_SIZE", self.lease_size)
+        self.lease_timeout = app.config.get("RATELIMIT_LEASE_TIMEOUT", self.lease_timeout)
+        self.max_entries = app.config.get("RATELIMIT_LEASE_MAX_ENTRIES", self.max_entries)
+        with self._lock:
+            self._leases.clear()
+            self.local_hits = 0
+            self.leased = 0
+        app.extensions["rate_limit_leases"] = self
+
+    def _parse(self, limit_value):
+        item = self._limits.get(limit_value)
+        if item is None:
+            item = self._limits[limit_value] = parse(limit_value)
+        return item
+
+    def spend(self, limit_value, key, scope):
+        """Spend one hit of the local lease without any I/O, False when there is none left
+
+        Args:
+            limit_value: str, e.g. "100/minute"
+            key: str identifying the client
+            scope: str, the endpoint the limit belongs to
+        Return: bool
+        """
+
+        now = time.monotonic()
+        with self._lock:
+            lease = self._leases.get((limit_value, key, scope))
+            if lease is not None and lease[0] > now and lease[1] > 0:
+                lease[1] -= 1
+                self.local_hits += 1
+                return True
+        return False
+
+    def take(self, limit_value, key, scope):
+        """Take a new lease from the shared storage and spend its first hit
+
+        Return: bool, False when the shared window has no room for a whole lease
+        """
+
+        if not limiter.limiter.hit(self._parse(limit_value), key, scope, cost=self.lease_size):
+            return False
+
+        lease_key = (limit_value, key, scope)
+        with self._lock:
+            self._leases[lease_key] = [time.monotonic() + self.lease_timeout, self.lease_size - 1]
+            self._leases.move_to_end(lease_key)
+            while len(self._leases) > self.max_entries:
+                self._leases.popitem(last=False)
+            self.leased += 1
+        return True
+
+    def allow(self, limit_value, key, scope):
+        """Spend one hit of a local lease, taking a new lease from the shared storage when needed
+
+        Args:
+            limit_value: str, e.g. "100/minute"
+            key: str identifying the client
+            scope: str, the endpoint the limit belongs to
+        Return: bool, False when the request must be checked by the limiter itself
+        """
+
+        if self.lease_size <= 1:
+            return False
+        return self.spend(limit_value, key, scope) or self.take(limit_value, key, scope)
+
+    def hit(self, limit_value, key, scope):
+        """Count a single hit in the shared window the way the limiter checks a request
+
+        Return: bool, False when the limit is exceeded
+        """
+
+        return limiter.limiter.hit(self._parse(limit_value), key, scope)
+
+    def exempt_when(self, limit_value):
+        """Return an exempt_when callable for @limiter.limit(limit_value) of a view"""
+
+        def exempt():
+            try:
+                return self.allow(limit_value, get_remote_address(), request.endpoint)
+            except Exception:
+                # let the limiter check the request, it knows how to handle a storage failure
+                return False
+
+        return exempt
+
+    def stats(self):
+        return {
+            "leases": len(self._leases),
+            "lease_size": self.lease_size,
+            "local_hits": self.local_hits,
+            "leased": self.leased,
+        }
+
+
+rate_limit_leases = RateLimitLeases()
@@ -0,0 +1,88 @@
+import json
+from http import HTTPStatus
+from urllib.parse import parse_qs
+
+from werkzeug.utils import redirect
+from werkzeug.wrappers import Response
+from werkzeug.wsgi import get_current_url, get_host
+
+from api.clicks import click_buffer
+from api.code_filter import code_filter
+from api.domains import domain_registry
+from api.rate_limits import rate_limit_leases
+from api.resolution import resolution_cache
+from api.utils import limiter
+
+# the body flask-restx answers abort(404, "URL Not Found") with
+NOT_FOUND_BODY = json.dumps({"message": "URL Not Found"}) + "\n"
+
+
+class RedirectMiddleware:
+    """WSGI middleware answering short code redirects before they reach flask-restx
+
+    A GET or HEAD of a bare `/<code>` path is resolved with the same resolution
+    cache, domain registry, code filter and click buffer as the Redirect
+    resource and answered with a 302, or the 404 of the API for an unknown
+    code, without building a request, matching a url rule or dispatching a
+    Resource. Everything else is passed to the wrapped app unchanged: other
+    paths and methods, hosts that are not ours, requests without a lease of
+    the redirect rate limit and errors, so 429s and 500s keep coming from the
+    API.
+
+    Mounted by create_app unless REDIRECT_FAST_PATH is False.
+    """
+
+    def __init__(self, app, wsgi_app, limit_value, endpoint):
+        self.app = app
+        self.wsgi_app = wsgi_app
+        self.limit_value = limit_value
+        self.endpoint = endpoint
+        self.default_domain = app.config["DEFAULT_DOMAIN"]
+        # single segment paths that have their own url rule, eg. /swagger.json
+        self.reserved = {rule.rule for rule in app.url_map.iter_rules() if not rule.arguments}
+        self.served = 0
+        self.passed = 0
+
+    def __call__(self, environ, start_response):
+        response = None
+        if environ.get("REQUEST_METHOD") in ("GET", "HEAD"):
+            path = environ.get("PATH_INFO", "")
+            if len(path) > 1 and path.find("/", 1) == -1 and path not in self.reserved:
+                try:
+                    response = self.handle(environ, path[1:])
+                except Exception:
+                    # let the app handle and log the error like any other request
+                    response = None
+        if response is None:
+            self.passed += 1
+            return self.wsgi_app(environ, start_response)
+        self.served += 1
+        return response(environ, start_response)
+
+    def handle(self, environ, code):
+        """Return the redirect response of a short code or None to leave the request to the app
+
+        Args:
+            environ: WSGI environ
+            code: str
+        Return: werkzeug Response or None
+        """
+
+        with self.app.app_context():
+            if get_current_url(environ, host_only=True) != self.default_domain:
+                if domain_registry.lookup(get_host(environ)) is None:
+                    return None
+            if limiter.enabled and not rate_limit_leases.allow(
+                self.limit_value, environ.get("REMOTE_ADDR") or "127.0.0.1", self.endpoint
+            ):
+                # the limiter counts the request exactly and answers with a 429 once the limit is hit
+                return None
+            target = None if code_filter.rejects(code) else resolution_cache.resolve(code)
+            if target is None:
+                return Response(NOT_FOUND_BODY, HTTPStatus.NOT_FOUND, mimetype="application/json")
+            referrer = parse_qs(environ.get("QUERY_STRING", ""), keep_blank_values=True).get("referrer", [None])[0]
+            click_buffer.record(target["id"], referrer)
+        return redirect(target["long_url"])
+
+    def stats(self):
+        return {"served": self.served, "passed": self.passed}
@@ -0,0 +1,214 @@
+import threading
+import time
+from collections import OrderedDict
+
+from api.codes import code_allocator
+from api.models import Url, User
+from api.singleflight import SingleFlight
+from api.utils import cache, db
+
+
+class ResolutionCache:
+    """Maps a short code to its redirect target (long url, owner and domain)
+
+    Lookups go through a bounded in-process LRU first and, when enabled,
+    a shared tier backed by the application cache before falling back to
+    the database. Entries are plain dicts so they can be stored in Redis.
+
+    invalidate() only reaches the LRU of the worker it runs in, so LRU entries
+    expire after `local_timeout` seconds. During the following `stale_timeout`
+    seconds one request reloads an expired entry while concurrent requests for
+    the same code keep getting the stale one, and concurrent misses of a code
+    share a single database lookup. Together that is how long another worker
+    can keep redirecting an edited or deleted link to its old target.
+    """
+
+    key_prefix = "resolve/"
+
+    def __init__(self, maxsize=10000, timeout=300, local_timeout=5, stale_timeout=5, use_shared=False):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.local_timeout = local_timeout
+        self.stale_timeout = stale_timeout
+        self.use_shared = use_shared
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+        self.hits = 0
+        self.stale_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        self.maxsize = app.config.get("RESOLUTION_CACHE_SIZE", self.maxsize)
+        self.timeout = app.config.get("RESOLUTION_CACHE_TIMEOUT", self.timeout)
+        self.local_timeout = app.config.get("RESOLUTION_CACHE_LOCAL_TIMEOUT", self.local_timeout)
+        self.stale_timeout = app.config.get("RESOLUTION_CACHE_STALE_TIMEOUT", self.stale_timeout)
+        self.use_shared = app.config.get("RESOLUTION_CACHE_SHARED", self.use_shared)
+        self.clear()
+        app.extensions["resolution_cache"] = self
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.stale_hits = self.shared_hits = self.misses = 0
+
+    def _get_local(self, code):
+        """Return (entry, is_fresh) from the LRU or None"""
+        with self._lock:
+            item = self._entries.get(code)
+            if item is None:
+                return None
+            expires_at, entry = item
+            now = time.monotonic()
+            if expires_at + self.stale_timeout <= now:
+                del self._entries[code]
+                return None
+            self._entries.move_to_end(code)
+            return entry, expires_at > now
+
+    def _set_local(self, code, entry):
+        with self._lock:
+            self._entries[code] = (time.monotonic() + self.local_timeout, entry)
+            self._entries.move_to_end(code)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def _get_shared(self, code):
+        if not self.use_shared:
+            return None
+        try:
+            return cache.get(f"{self.key_prefix}{code}")
+        except Exception:
+            return None
+
+    def _set_shared(self, code, entry):
+        if not self.use_shared:
+            return
+        try:
+            cache.set(f"{self.key_prefix}{code}", entry, timeout=self.timeout)
+        except Exception:
+            pass
+
+    def get(self, code):
+        """Return the fresh cached entry for a short code without touching the database
+
+        Args:
+            code: str
+        Return: entry: dict or None
+        """
+
+        item = self._get_local(code)
+        if item is not None and item[1]:
+            self.hits += 1
+            return item[0]
+
+        entry = self._get_shared(code)
+        if entry is not None:
+            self.shared_hits += 1
+            self._set_local(code, entry)
+            return entry
+
+        self.misses += 1
+        return None
+
+    def set(self, code, entry):
+        self._set_local(code, entry)
+        self._set_shared(code, entry)
+
+    @staticmethod
+    def load_statement(code):
+        """Build the query reading the redirect target of a short code
+        Codes made by the code allocator are looked up by primary key
+
+        Args:
+            code: str
+        Return: sqlalchemy Select
+        """
+
+        statement = db.select(Url.id, Url.uuid, Url.long_url, Url.user_id, User.custom_domain).join(
+            User, Url.user_id == User.id
+        )
+        url_id = code_allocator.decode(code)
+        if url_id is not None:
+            statement = statement.where(Url.id == url_id)
+        else:
+            statement = statement.where(Url.uuid == code)
+        return statement.limit(1)
+
+    @staticmethod
+    def entry_from_row(code, row):
+        """Turn a row of load_statement into a cache entry, None when the row is not the code"""
+
+        if row is None or row.uuid != code:
+            return None
+        return {"id": row.id, "long_url": row.long_url, "user_id": row.user_id, "domain": row.custom_domain}
+
+    def load(self, code):
+        """Read the redirect target of a short code from the database
+
+        Args:
+            code: str
+        Return: entry: dict or None
+        """
+
+        return self.entry_from_row(code, db.session.execute(self.load_statement(code)).first())
+
+    def _refresh(self, code):
+        entry = self.get(code)
+        if entry is None:
+            entry = self.load(code)
+            if entry is None:
+                with self._lock:
+                    self._entries.pop(code, None)
+            else:
+                self.set(code, entry)
+        return entry
+
+    def resolve(self, code):
+        """Read-through lookup of a short code
+
+        Args:
+            code: str
+        Return: entry: dict or None if the code does not exist
+        """
+
+        item = self._get_local(code)
+        if item is not None:
+            entry, is_fresh = item
+            if is_fresh:
+                self.hits += 1
+                return entry
+            if self._flight.running(code):
+                # another request is reloading the code, answer with what we had
+                self.stale_hits += 1
+                return entry
+        return self._flight.do(code, lambda: self._refresh(code))
+
+    def invalidate(self, *codes):
+        """Drop short codes from every tier so the next lookup reads the database"""
+
+        with self._lock:
+            for code in codes:
+                self._entries.pop(code, None)
+        if self.use_shared and codes:
+            try:
+                cache.delete_many(*[f"{self.key_prefix}{code}" for code in codes])
+            except Exception:
+                pass
+
+    def stats(self):
+        lookups = self.hits + self.stale_hits + self.shared_hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "coalesced": self._flight.coalesced,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.hits + self.stale_hits + self.shared_hits) / lookups, 4) if lookups else 0.0,
+        }
+
+
+resolution_cache = ResolutionCache()
@@ -0,0 +1,110 @@
+import hashlib
+import time
+import uuid
+from functools import wraps
+from urllib.parse import urlencode
+
+from flask import request
+from flask_jwt_extended import get_jwt_identity
+
+from api.singleflight import SingleFlight
+from api.utils import cache
+
+
+class UserResponseCache:
+    """Caches the responses of GET endpoints per user
+
+    A cached response is keyed on the JWT identity, the path, the query string
+    and the current version of the user. Every endpoint that changes the data
+    of a user replaces that version, so all cached responses of the user are
+    invalidated at once without deleting any key; the old entries simply
+    expire. Versions are random tokens rather than counters, a version that
+    was evicted from the cache can therefore never bring old entries back.
+
+    Concurrent misses of the same key in a worker share one call of the
+    endpoint. With a `stale_timeout` an expired response is still served for
+    that long to concurrent requests while one of them recomputes it.
+    """
+
+    key_prefix = "user-view/"
+    version_prefix = "user-version/"
+
+    def __init__(self):
+        self._flight = SingleFlight()
+
+    def version(self, user_id):
+        """Return the current cache version of a user, None when the cache is unavailable"""
+
+        key = f"{self.version_prefix}{user_id}"
+        try:
+            version = cache.get(key)
+            if version is None:
+                cache.add(key, uuid.uuid4().hex, timeout=0)
+                version = cache.get(key)
+            return version
+        except Exception:
+            return None
+
+    def bump(self, user_id):
+        """Invalidate every cached response of a user"""
+
+        try:
+            cache.set(f"{self.version_prefix}{user_id}", uuid.uuid4().hex, timeout=0)
+        except Exception:
+            pass
+
+    def make_key(self, user_id, version):
+        query = urlencode(sorted(request.args.items(multi=True)))
+        query_hash = hashlib.md5(query.encode("utf-8")).hexdigest()
+        return f"{self.key_prefix}{user_id}/{version}{request.path}?{query_hash}"
+
+    def cached(self, timeout=60, stale_timeout=0):
+        """Cache the return value of a GET endpoint for the current user, goes below @jwt_required()"""
+
+        def decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                if request.method not in ("GET", "HEAD"):
+                    return f(*args, **kwargs)
+                user_id = get_jwt_identity()
+                version = self.version(user_id)
+                if version is None:
+                    return f(*args, **kwargs)
+
+                key = self.make_key(user_id, version)
+                try:
+                    cached = cache.get(key)
+                except Exception:
+                    cached = None
+                if cached is not None:
+                    fresh_until, response = cached
+                    if time.time() < fresh_until or self._flight.running(key):
+                        return response
+
+                def compute():
+                    response = f(*args, **kwargs)
+                    try:
+                        cache.set(key, (time.time() + timeout, response), timeout=timeout + stale_timeout)
+                    except Exception:
+                        pass
+                    return response
+
+                return self._flight.do(key, compute)
+
+            return wrapper
+
+        return decorator
+
+    def invalidates(self, f):
+        """Invalidate the cached responses of the current user after the endpoint ran, goes below @jwt_required()"""
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            response = f(*args, **kwargs)
+            self.bump(get_jwt_identity())
+            return response
+
+        return wrapper
+
+
+response_cache = UserResponseCache()
@@ -0,0 +1,61 @@
+import threading
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesces concurrent computations of the same key within a process
+
+    The first caller of do() for a key runs the function, callers arriving
+    while it runs wait for its result instead of running the function again.
+    """
+
+    def __init__(self, wait_timeout=10):
+        self.wait_timeout = wait_timeout
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    def running(self, key):
+        return key in self._calls
+
+    def do(self, key, fn):
+        """Run fn for key unless another caller already is, and return its result
+
+        Args:
+            key: hashable
+            fn: function without arguments
+        Return: the result of fn
+        """
+
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.coalesced += 1
+
+        if not is_leader:
+            if not call.done.wait(self.wait_timeout):
+                # the leader is stuck, do not make every waiter time out with it
+                return fn()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
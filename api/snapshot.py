@@ -0,0 +1,288 @@
+import heapq
+import mmap
+import os
+import struct
+import time
+
+import click
+from flask.cli import AppGroup
+
+from api.domains import DomainRegistry
+from api.models import Url, User
+from api.utils import db, write_file
+
+MAGIC = b"SCISSNAP"
+VERSION = 2
+FLAG_DELTA = 1
+# magic, version, flags, number of records, unix time the snapshot was taken
+HEADER = struct.Struct("<8sIIQQ")
+# lengths of the code, the host of the owner's custom domain and the long url
+RECORD = struct.Struct("<HHI")
+# sort key of a code and offset of its record, the key is the first KEY_SIZE bytes
+# of the code zero padded and read as two big-endian ints, so they order like the codes
+INDEX = struct.Struct(">QQQ")
+KEY = struct.Struct(">QQ")
+KEY_SIZE = KEY.size
+# url length of a record removing the code in a delta file
+TOMBSTONE = 0xFFFFFFFF
+
+snapshot_cli = AppGroup("snapshot", help="Export short codes for redirect nodes without a database.")
+
+
+def sort_key(code):
+    """Return the index key of a code, codes sharing their first KEY_SIZE bytes share a key
+
+    Args:
+        code: bytes
+    Return: tuple of ints
+    """
+
+    return KEY.unpack(code[:KEY_SIZE].ljust(KEY_SIZE, b"\0"))
+
+
+class Snapshot:
+    """A memory-mapped snapshot or delta file
+
+    The file holds a header, an index of code keys and record offsets and the
+    records sorted by code:
+
+        header | key and offset of record 0 .. n-1 | code host url | code host url | ...
+
+    A lookup binary searches the integer keys of the index and reads the
+    record through a memoryview of the mapped pages, so no bytes are copied
+    until the long url is decoded. Every worker process opening the same file
+    shares one copy of it in the page cache and opening it costs nothing.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, flags, self.count, self.created_at = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            self._mm.close()
+            raise ValueError(f"{path} is not a snapshot file of version {VERSION}")
+        self.is_delta = bool(flags & FLAG_DELTA)
+        self._view = memoryview(self._mm)
+
+    def close(self):
+        self._view.release()
+        self._mm.close()
+
+    def _entry(self, i):
+        return INDEX.unpack_from(self._mm, HEADER.size + i * INDEX.size)
+
+    def _record_at(self, offset):
+        code_length, host_length, url_length = RECORD.unpack_from(self._mm, offset)
+        start = offset + RECORD.size
+        code = self._view[start:start + code_length]
+        start += code_length
+        host = self._view[start:start + host_length]
+        start += host_length
+        if url_length == TOMBSTONE:
+            return code, host, None
+        return code, host, self._view[start:start + url_length]
+
+    def find(self, code):
+        """Return the (code, host, long_url) record of a code as memoryviews of the file, None when it is not in it
+
+        long_url is None for a code removed by a delta file
+
+        Args:
+            code: bytes
+        Return: tuple or None
+        """
+
+        key = sort_key(code)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._entry(middle)[:2] < key:
+                low = middle + 1
+            else:
+                high = middle
+        # only codes longer than KEY_SIZE bytes can share a key
+        while low < self.count:
+            key_high, key_low, offset = self._entry(low)
+            if (key_high, key_low) != key:
+                break
+            record = self._record_at(offset)
+            if record[0] == code:
+                return record
+            low += 1
+        return None
+
+    def records(self):
+        """Iterate over every record in code order, copied to bytes"""
+
+        for i in range(self.count):
+            code, host, long_url = self._record_at(self._entry(i)[2])
+            yield bytes(code), bytes(host), None if long_url is None else bytes(long_url)
+
+
+class SnapshotReader:
+    """Resolves short codes from a snapshot and the delta files taken after it
+
+    Deltas are searched newest first, a code removed by a delta is not
+    resolved even when it is in the snapshot. A code is only served on the
+    default domain or on the custom domain of its owner.
+    """
+
+    def __init__(self, path, delta_paths=(), default_host=None):
+        self.snapshot = Snapshot(path)
+        self.deltas = [Snapshot(delta_path) for delta_path in delta_paths]
+        self.default_host = default_host
+
+    def close(self):
+        for snapshot in [self.snapshot, *self.deltas]:
+            snapshot.close()
+
+    def find(self, code):
+        for snapshot in [*reversed(self.deltas), self.snapshot]:
+            record = snapshot.find(code)
+            if record is not None:
+                return record if record[2] is not None else None
+        return None
+
+    def get(self, code):
+        """Return (long_url, host) of a short code, host is None for users without a custom domain
+
+        Args:
+            code: str
+        Return: tuple or None
+        """
+
+        record = self.find(code.encode("utf-8"))
+        if record is None:
+            return None
+        _, host, long_url = record
+        return str(long_url, "utf-8"), str(host, "utf-8") or None
+
+    def resolve(self, code, host=None):
+        """Return the long url a short code redirects to on a host, None when it does not redirect there
+
+        Args:
+            code: str
+            host: str or None to ignore the host
+        Return: long_url: str or None
+        """
+
+        entry = self.get(code)
+        if entry is None:
+            return None
+        long_url, owner_host = entry
+        if host is not None and host != self.default_host and host != owner_host:
+            return None
+        return long_url
+
+    def records(self):
+        """Iterate over the current records in code order, deltas applied"""
+
+        changes = {}
+        for delta in self.deltas:
+            for record in delta.records():
+                changes[record[0]] = record
+        base = (record for record in self.snapshot.records() if record[0] not in changes)
+        for record in heapq.merge(base, sorted(changes.values())):
+            if record[2] is not None:
+                yield record
+
+
+def encode_records(records, created_at=None, is_delta=False):
+    """Encode sorted (code, host, long_url) byte records into a snapshot file
+
+    Args:
+        records: list of tuples of bytes sorted by code, long_url None for a removed code
+        created_at: unix time, defaults to now
+        is_delta: bool
+    Return: bytes
+    """
+
+    index = bytearray()
+    body = bytearray()
+    start = HEADER.size + len(records) * INDEX.size
+    for code, host, long_url in records:
+        index += INDEX.pack(*sort_key(code), start + len(body))
+        url_length = TOMBSTONE if long_url is None else len(long_url)
+        body += RECORD.pack(len(code), len(host), url_length)
+        body += code
+        body += host
+        if long_url is not None:
+            body += long_url
+    flags = FLAG_DELTA if is_delta else 0
+    header = HEADER.pack(MAGIC, VERSION, flags, len(records), int(created_at or time.time()))
+    return bytes(header + index + body)
+
+
+def current_records():
+    """Read every short code with its long url and the host of its owner's custom domain, sorted by code
+
+    Sorted in Python since the collation of the database may not order bytes
+
+    Return: list of tuples of bytes
+    """
+
+    query = (
+        db.select(Url.uuid, Url.long_url, User.custom_domain)
+        .join(User, Url.user_id == User.id)
+        .execution_options(yield_per=10000)
+    )
+    records = [
+        (code.encode("utf-8"), (DomainRegistry.host_of(domain) or "").encode("utf-8"), long_url.encode("utf-8"))
+        for code, long_url, domain in db.session.execute(query)
+    ]
+    records.sort()
+    return records
+
+
+def diff_records(old, new):
+    """Return the records turning the sorted records old into the sorted records new
+
+    Args:
+        old: iterable of records sorted by code
+        new: iterable of records sorted by code
+    Return: list of records, long_url None for removed codes
+    """
+
+    changes = []
+    old, new = iter(old), iter(new)
+    old_record, new_record = next(old, None), next(new, None)
+    while old_record is not None or new_record is not None:
+        if new_record is None or (old_record is not None and old_record[0] < new_record[0]):
+            changes.append((old_record[0], b"", None))
+            old_record = next(old, None)
+        elif old_record is None or new_record[0] < old_record[0]:
+            changes.append(new_record)
+            new_record = next(new, None)
+        else:
+            if old_record[1:] != new_record[1:]:
+                changes.append(new_record)
+            old_record, new_record = next(old, None), next(new, None)
+    return changes
+
+
+@snapshot_cli.command("export")
+@click.argument("path", type=click.Path(dir_okay=False))
+def export_snapshot(path):
+    """Write every short code to a snapshot file at PATH"""
+
+    records = current_records()
+    write_file(os.path.abspath(path), encode_records(records))
+    click.echo(f"Wrote {len(records)} codes to {path}")
+
+
+@snapshot_cli.command("delta")
+@click.argument("base", type=click.Path(exists=True, dir_okay=False))
+@click.argument("path", type=click.Path(dir_okay=False))
+@click.option("--delta", "deltas", multiple=True, type=click.Path(exists=True, dir_okay=False),
+              help="Delta file already applied on top of BASE, oldest first, can be repeated.")
+def export_delta(base, path, deltas):
+    """Write the codes added, changed or removed since BASE and its deltas to a delta file at PATH"""
+
+    reader = SnapshotReader(base, deltas)
+    try:
+        changes = diff_records(reader.records(), current_records())
+    finally:
+        reader.close()
+    write_file(os.path.abspath(path), encode_records(changes, is_delta=True))
+    click.echo(f"Wrote {len(changes)} changed codes to {path}")
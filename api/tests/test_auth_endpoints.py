@@ -1,11 +1,18 @@
+import email
+import socket
+import socketserver
+import threading
 import unittest
+from datetime import datetime, timedelta
 
 from flask_jwt_extended import create_access_token
 from werkzeug.security import generate_password_hash
 
 from api import create_app
 from api.config import config_dict
-from api.models import User
+from api.mail import mail_sender
+from api.models import MailMessage, User
+from api.passwords import password_hasher
 from api.utils import TokenService, db
 
 user_data = {
@@ -34,6 +41,53 @@ def create_user(data):
     return user
 
 
+class SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line + b"\r\n")
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply(b"220 localhost")
+        for line in self.rfile:
+            command = line.split(maxsplit=1)[0].upper() if line.strip() else b""
+            if command == b"DATA":
+                self.reply(b"354 End data with <CR><LF>.<CR><LF>")
+                data = []
+                for data_line in self.rfile:
+                    if data_line == b".\r\n":
+                        break
+                    data.append(data_line)
+                self.server.messages.append(email.message_from_bytes(b"".join(data)))
+                self.reply(b"250 OK")
+            elif command == b"NOOP":
+                self.server.noops += 1
+                self.reply(b"250 OK")
+            elif command == b"QUIT":
+                self.reply(b"221 Bye")
+                return
+            else:
+                # EHLO, MAIL, RCPT and RSET
+                self.reply(b"250 OK")
+
+
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    """A local SMTP server keeping the messages it receives"""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("localhost", 0), SMTPHandler)
+        self.port = self.server_address[1]
+        self.messages = []
+        self.connections = 0
+        self.noops = 0
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
 class RegisterTestCase(unittest.TestCase):
     register_data = user_data.copy()
     register_endpoint = "/auth/register"
@@ -145,6 +199,21 @@ class LoginTestCase(unittest.TestCase):
         response = self.client.post(self.login_endpoint, json=data)
         self.assertEqual(response.status_code, 401)
 
+    def test_login_upgrades_password_hash(self):
+        user = create_user(self.register_data)
+        self.assertTrue(password_hasher.needs_rehash(user.password_hash))
+        response = self.client.post(self.login_endpoint, json=self.login_data)
+        self.assertEqual(response.status_code, 200)
+        db.session.refresh(user)
+        self.assertTrue(user.password_hash.startswith(f"{password_hasher.method_string}$"))
+        response = self.client.post(self.login_endpoint, json=self.login_data)
+        self.assertEqual(response.status_code, 200)
+
+    def test_password_benchmark(self):
+        result = self.app.test_cli_runner().invoke(args=["passwords", "benchmark", "--logins", "5"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("logins per second per core", result.output)
+
 
 class PasswordResetTestCase(unittest.TestCase):
     password_reset_request = "/auth/password-reset-request"
@@ -176,6 +245,42 @@ class PasswordResetTestCase(unittest.TestCase):
         response = self.client.post(self.password_reset_request, json=self.email)
         self.assertEqual(response.status_code, 200)
 
+    def test_password_reset_mail_sent_from_outbox(self):
+        smtp = SMTPStandIn()
+        self.addCleanup(smtp.stop)
+        self.addCleanup(mail_sender.close)
+        self.app.config["MAIL_PORT"] = smtp.port
+        create_user(user_data)
+
+        response = self.client.post(self.password_reset_request, json=self.email)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(smtp.messages, [])
+        self.assertEqual(mail_sender.send_pending(), 1)
+        self.assertEqual(smtp.messages[0]["To"], user_data["email"])
+        self.assertIn("auth/password-reset/", smtp.messages[0].get_payload(decode=True).decode())
+        self.assertEqual(MailMessage.query.one().status, "sent")
+
+        # later messages reuse the open connection, checked once per batch
+        for _ in range(2):
+            self.client.post(self.password_reset_request, json=self.username)
+        self.assertEqual(mail_sender.send_pending(), 2)
+        self.assertEqual((len(smtp.messages), smtp.connections, smtp.noops), (3, 1, 1))
+
+    def test_password_reset_mail_retried_with_backoff(self):
+        with socket.socket() as closed:
+            closed.bind(("localhost", 0))
+            self.app.config["MAIL_PORT"] = closed.getsockname()[1]
+        create_user(user_data)
+        self.client.post(self.password_reset_request, json=self.email)
+
+        self.assertEqual(mail_sender.send_pending(), 0)
+        message = MailMessage.query.one()
+        self.assertEqual((message.status, message.attempts), ("pending", 1))
+        self.assertGreater(message.next_attempt_at, datetime.utcnow() + timedelta(seconds=20))
+        # not due yet
+        self.assertEqual(mail_sender.send_pending(), 0)
+        self.assertEqual(MailMessage.query.one().attempts, 1)
+
     def test_send_password_reset_email_fail_user_not_found(self):
         response = self.client.post(self.password_reset_request, json=self.email)
         self.assertEqual(response.status_code, 406)
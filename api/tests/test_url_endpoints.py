@@ -1,14 +1,42 @@
+import asyncio
+import csv
+import importlib.util
+import json
 import os
+import tempfile
+import threading
+import time
 import unittest
+import unittest.mock
+import zipfile
+from datetime import datetime
+from io import BytesIO
 
 import shortuuid
+import sqlalchemy
+from decouple import config
+from flask_caching.backends import SimpleCache
 from flask_jwt_extended import create_access_token
+from limits import parse
 from werkzeug.security import generate_password_hash
 
 from api import create_app
+from api.asgi import AsyncRedirectApp, create_asgi_app
 from api.config import config_dict
-from api.models import DeletedUrl, Url, User
-from api.utils import db
+from api.clicks import click_buffer
+from api.code_filter import code_filter
+from api.codes import code_allocator
+from api.models import DeletedUrl, Url, UrlDailyClicks, UrlHourlyClicks, UrlReferrerCount, User
+from api.qr import QRCache, qr_cache, qr_payload
+from api.rate_limits import rate_limit_leases
+from api.resolution import ResolutionCache, resolution_cache
+from api.singleflight import SingleFlight
+from api.snapshot import Snapshot, SnapshotReader, encode_records
+from api.tiered_cache import TieredCache
+from api.url_routes import REDIRECT_LIMIT
+from api.utils import db, limiter
+
+DEFAULT_DOMAIN = config("DEFAULT_DOMAIN")
 
 user_data = {
     "username": "testuser",
@@ -59,6 +87,54 @@ def create_url():
     return user, url
 
 
+def asgi_scope(path, host="localhost", method="GET", client="10.0.0.1"):
+    return {"type": "http", "method": method, "scheme": "http", "path": path, "root_path": "",
+            "query_string": b"referrer=qr", "headers": [(b"host", host.encode())], "client": (client, 1)}
+
+
+class SessionEngine:
+    """An async engine stand-in running the statements on the session of the test app"""
+
+    def __init__(self):
+        self.statements = []
+        self.disposed = False
+
+    def connect(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def execute(self, statement):
+        self.statements.append(statement)
+        # yield to the event loop like a real driver so concurrent lookups overlap
+        await asyncio.sleep(0)
+        return db.session.execute(statement)
+
+    async def dispose(self):
+        self.disposed = True
+
+
+class RedisStandIn:
+    """A redis.asyncio client stand-in keeping the values in a dict"""
+
+    def __init__(self):
+        self.values = {}
+        self.closed = False
+
+    async def get(self, key):
+        return self.values.get(key)
+
+    async def setex(self, key, timeout, value):
+        self.values[key] = value
+
+    async def close(self):
+        self.closed = True
+
+
 class URLTestCase(unittest.TestCase):
     get_all_urls = "/urls/all-urls"
     one_url = "/urls/{uuid}"
@@ -89,6 +165,47 @@ class URLTestCase(unittest.TestCase):
         response = self.client.get(self.get_all_urls, headers=headers)
         self.assertEqual(response.status_code, 200)
 
+    def test_get_all_urls_cached_per_user(self):
+        user, url = create_url()
+        second_user = create_user(custom_data=second_user_data.copy())
+        headers = {"Authorization": f"Bearer {create_access_token(identity=user.id)}"}
+        second_headers = {"Authorization": f"Bearer {create_access_token(identity=second_user.id)}"}
+
+        response = self.client.get(self.get_all_urls, headers=headers)
+        self.assertEqual(len(response.json), 1)
+        response = self.client.get(self.get_all_urls, headers=second_headers)
+        self.assertEqual(response.json, [])
+
+        # served from the cache until the user changes their urls
+        Url(user_id=user.id, uuid=shortuuid.random(length=6), long_url=f"{test_url}other").save()
+        response = self.client.get(self.get_all_urls, headers=headers)
+        self.assertEqual(len(response.json), 1)
+        response = self.client.delete(self.one_url.format(uuid=url.uuid), headers=headers)
+        self.assertEqual(response.status_code, 204)
+        response = self.client.get(self.get_all_urls, headers=headers)
+        self.assertEqual([item["long_url"] for item in response.json], [f"{test_url}other"])
+
+        data = {"url": f"{test_url}new", "title": test_title}
+        self.client.post(self.shorten_url, json=data, headers=headers)
+        response = self.client.post(self.shorten_url, json=data, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(self.get_all_urls, headers=headers)
+        self.assertEqual(len(response.json), 2)
+
+    def test_tiered_cache_promotes_and_demotes(self):
+        tiered = TieredCache(SimpleCache(), l1_size=1, l1_timeout=60, l1_skip_prefixes=("skip/",))
+        tiered.set("a", 1)
+        tiered.set("b", 2)
+        self.assertEqual(tiered.stats()["demotions"], 1)
+        self.assertEqual(tiered.get("a"), 1)
+        self.assertEqual(tiered.get("a"), 1)
+        tiered.set("skip/c", 3)
+        self.assertEqual(tiered.get("skip/c"), 3)
+        stats = tiered.stats()
+        self.assertEqual((stats["l1_hits"], stats["l2_hits"], stats["promotions"]), (1, 2, 1))
+        tiered.delete("a")
+        self.assertIsNone(tiered.get("a"))
+
     def test_get_one_url_success(self):
         user, url = create_url()
         token = create_access_token(identity=user.id)
@@ -153,6 +270,77 @@ class URLTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(os.path.exists(url.qr_code), True)
 
+    def test_generate_qrcode_cached_with_etag(self):
+        user, url = create_url()
+        token = create_access_token(identity=user.id)
+        headers = {"Authorization": f"Bearer {token}"}
+        response = self.client.get(self.generate_qr_code.format(uuid=url.uuid), headers=headers)
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers["ETag"]
+        self.assertEqual(qr_cache.stats()["renders"], 1)
+
+        response = self.client.get(self.generate_qr_code.format(uuid=url.uuid), headers=headers)
+        self.assertEqual(response.headers["ETag"], etag)
+        self.assertEqual(qr_cache.stats()["renders"], 1)
+        self.assertEqual(qr_cache.stats()["hits"], 1)
+
+        headers["If-None-Match"] = etag
+        response = self.client.get(self.generate_qr_code.format(uuid=url.uuid), headers=headers)
+        self.assertEqual(response.status_code, 304)
+
+    def test_generate_qrcode_formats_and_sizes(self):
+        user, url = create_url()
+        token = create_access_token(identity=user.id)
+        headers = {"Authorization": f"Bearer {token}"}
+        endpoint = self.generate_qr_code.format(uuid=url.uuid)
+        for size in [128, 256, 512]:
+            response = self.client.get(f"{endpoint}?size={size}", headers=headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, "image/png")
+            self.assertTrue(response.data.startswith(b"\x89PNG"))
+        response = self.client.get(f"{endpoint}?format=svg&size=256", headers=headers)
+        self.assertEqual(response.mimetype, "image/svg+xml")
+        self.assertIn(b'width="', response.data)
+        stats = qr_cache.stats()
+        self.assertEqual(stats["renders"], 1)
+        self.assertEqual(stats["rasterisations"], 4)
+
+        response = self.client.get(f"{endpoint}?format=jpeg", headers=headers)
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(f"{endpoint}?size=10", headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+        # sizes between two of QR_SIZES are the same image
+        etags = {self.client.get(f"{endpoint}?size={size}", headers=headers).headers["ETag"] for size in [300, 400]}
+        self.assertEqual(etags, {f'"{qr_cache.key(qr_payload(DEFAULT_DOMAIN, url.uuid), "png", 256)}"'})
+        self.assertEqual(qr_cache.stats()["rasterisations"], 4)
+
+    def test_qr_cache_directory_bounded(self):
+        cache = QRCache(directory=tempfile.mkdtemp(), max_files=10)
+        cache.get_many([f"{test_url}{i}" for i in range(12)])
+        # the 11th image pruned the directory down to 9 files, the 12th did not go over the bound
+        self.assertEqual(cache.stats()["pruned"], 2)
+        self.assertEqual(len(os.listdir(cache.directory)), cache.stats()["files"])
+        self.assertEqual(cache.stats()["files"], 10)
+
+    def test_download_qr_codes_zip(self):
+        user, url = create_url()
+        for i in range(2):
+            Url(user_id=user.id, uuid=shortuuid.random(length=6), long_url=f"{test_url}{i}").save()
+        token = create_access_token(identity=user.id)
+        headers = {"Authorization": f"Bearer {token}"}
+        self.client.get(self.generate_qr_code.format(uuid=url.uuid), headers=headers)
+        self.app.config["QR_ZIP_WINDOW"] = 2
+        response = self.client.get("/urls/qr-codes.zip", headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_streamed)
+        with zipfile.ZipFile(BytesIO(response.data)) as archive:
+            names = archive.namelist()
+            self.assertEqual(len(names), 3)
+            self.assertIn(f"{url.uuid}_qrcode.png", names)
+            self.assertTrue(archive.read(names[0]).startswith(b"\x89PNG"))
+        self.assertEqual(qr_cache.stats()["renders"], 3)
+
     def test_get_deleted_urls_success(self):
         user, url = create_url()
         token = create_access_token(identity=user.id)
@@ -170,3 +358,590 @@ class URLTestCase(unittest.TestCase):
         self.client.delete(self.one_url.format(uuid=url.uuid), headers=headers)
         response = self.client.get(self.restore_url.format(id=url.id), headers=headers)
         self.assertEqual(response.status_code, 201)
+
+    def test_redirect_success(self):
+        _, url = create_url()
+        response = self.client.get(self.redirect.format(uuid=url.uuid), base_url=DEFAULT_DOMAIN)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.location, test_url)
+        self.assertEqual(click_buffer.flush(), 1)
+        db.session.refresh(url)
+        self.assertEqual(url.clicks, 1)
+
+    def test_redirect_served_before_the_api(self):
+        _, url = create_url()
+        middleware = self.app.extensions["redirect_middleware"]
+        response = self.client.get(f"{self.redirect.format(uuid=url.uuid)}?referrer=qr", base_url=DEFAULT_DOMAIN)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.location, test_url)
+        self.assertEqual(middleware.stats(), {"served": 1, "passed": 0})
+        click_buffer.flush()
+        self.assertEqual(UrlReferrerCount.query.filter_by(url_id=url.id).one().referrer, "qr")
+
+        response = self.client.get(self.redirect.format(uuid="zzzzzz"), base_url=DEFAULT_DOMAIN)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json, {"message": "URL Not Found"})
+        self.assertEqual(middleware.stats(), {"served": 2, "passed": 0})
+
+        # other hosts and other routes are left to the api
+        response = self.client.get(self.redirect.format(uuid=url.uuid), base_url="https://example.com/")
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get("/swagger.json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(middleware.stats(), {"served": 2, "passed": 2})
+
+    @unittest.skipUnless(importlib.util.find_spec("aiosqlite"), "needs the aiosqlite driver")
+    def test_asgi_redirect(self):
+        database = os.path.join(tempfile.mkdtemp(), "scissor.db")
+
+        class AsyncConfig(config_dict["testing"]):
+            SQLALCHEMY_DATABASE_URI = f"sqlite:///{database}"
+
+        asgi_app = create_asgi_app(AsyncConfig)
+        with asgi_app.flask_app.app_context():
+            db.create_all()
+            _, url = create_url()
+            code = url.uuid
+
+        async def get(path, host="localhost"):
+            messages = []
+
+            async def send(message):
+                messages.append(message)
+
+            await asgi_app(asgi_scope(path, host), None, send)
+            return messages[0]["status"], dict(messages[0]["headers"])
+
+        async def run():
+            responses = await asyncio.gather(*[get(f"/{code}") for _ in range(20)])
+            responses.append(await get("/zzzzzz"))
+            responses.append(await get(f"/{code}", host="example.com"))
+            await asgi_app.close()
+            return responses
+
+        responses = asyncio.run(run())
+        self.assertEqual([status for status, _ in responses], [302] * 20 + [404, 404])
+        self.assertEqual(responses[0][1][b"location"], test_url.encode())
+        self.assertEqual(asgi_app.stats()["served"], 20)
+        self.assertGreater(asgi_app.stats()["coalesced"], 0)
+        with asgi_app.flask_app.app_context():
+            self.assertEqual(Url.query.filter_by(uuid=code).one().clicks, 20)
+
+    def test_asgi_redirect_resolves_through_shared_tier_and_database(self):
+        _, url = create_url()
+        code = url.uuid
+        engine, redis = SessionEngine(), RedisStandIn()
+        with unittest.mock.patch("api.asgi.create_async_engine", return_value=engine):
+            asgi_app = AsyncRedirectApp(self.app)
+        asgi_app.redis = redis
+
+        async def run():
+            return await asyncio.gather(*[asgi_app.handle(asgi_scope(f"/{code}")) for _ in range(20)])
+
+        responses = asyncio.run(run())
+        self.assertEqual({status for status, _, _ in responses}, {302})
+        self.assertEqual(dict(responses[0][1])[b"location"], test_url.encode())
+        # concurrent misses share one database lookup, its entry is written to the shared tier
+        self.assertEqual(len(engine.statements), 1)
+        self.assertGreater(asgi_app.stats()["coalesced"], 0)
+        self.assertEqual(asgi_app.serializer.loads(redis.values[f"{asgi_app.redis_prefix}{code}"])["id"], url.id)
+        self.assertEqual(click_buffer.flush(), 20)
+
+        # another worker finds the entry in the shared tier without a query
+        other_engine = SessionEngine()
+        with unittest.mock.patch("api.asgi.create_async_engine", return_value=other_engine):
+            other_app = AsyncRedirectApp(self.app)
+        other_app.redis = redis
+        self.assertEqual(asyncio.run(other_app.resolve(code))["long_url"], test_url)
+        self.assertEqual(other_engine.statements, [])
+
+        async def errors():
+            return [
+                (await asgi_app.handle(asgi_scope("/zzzzzz")))[0],
+                (await asgi_app.handle(asgi_scope(f"/{code}", method="POST")))[0],
+                (await asgi_app.handle(asgi_scope(f"/{code}", host="example.com")))[0],
+            ]
+
+        self.assertEqual(asyncio.run(errors()), [404, 405, 404])
+
+        async def lifespan():
+            received = iter([{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}])
+            sent = []
+
+            async def receive():
+                return next(received)
+
+            async def send(message):
+                sent.append(message["type"])
+
+            await asgi_app({"type": "lifespan"}, receive, send)
+            return sent
+
+        self.assertEqual(asyncio.run(lifespan()), ["lifespan.startup.complete", "lifespan.shutdown.complete"])
+        self.assertTrue(engine.disposed)
+        self.assertTrue(redis.closed)
+
+    def test_asgi_redirect_rate_limit(self):
+        _, url = create_url()
+        with unittest.mock.patch("api.asgi.create_async_engine", return_value=SessionEngine()):
+            asgi_app = AsyncRedirectApp(self.app)
+
+        async def allowed(client, requests):
+            return [await asgi_app.within_limit(client) for _ in range(requests)]
+
+        # leased from the shared window like the flask workers do
+        self.assertEqual(asyncio.run(allowed("10.0.0.1", 3)), [True] * 3)
+        self.assertEqual((rate_limit_leases.leased, rate_limit_leases.local_hits), (1, 2))
+
+        # without leases every request is a single hit of the shared window
+        with unittest.mock.patch.object(rate_limit_leases, "lease_size", 1):
+            self.assertEqual(asyncio.run(allowed("10.0.0.2", 101)), [True] * 100 + [False])
+            status, _, body = asyncio.run(asgi_app.handle(asgi_scope(f"/{url.uuid}", client="10.0.0.2")))
+        self.assertEqual(status, 429)
+        self.assertEqual(json.loads(body), {"message": f"{REDIRECT_LIMIT} exceeded"})
+        self.assertEqual(rate_limit_leases.leased, 1)
+
+    def test_snapshot_export_and_delta(self):
+        user, url = create_url()
+        other_url = Url(user_id=user.id, uuid=shortuuid.random(length=6), long_url=f"{test_url}other")
+        other_url.save()
+        code, other_code = url.uuid, other_url.uuid
+        directory = tempfile.mkdtemp()
+        base, delta = os.path.join(directory, "urls.snap"), os.path.join(directory, "urls.delta")
+        runner = self.app.test_cli_runner()
+
+        result = runner.invoke(args=["snapshot", "export", base])
+        self.assertEqual(result.exit_code, 0, result.output)
+        reader = SnapshotReader(base, default_host="localhost")
+        self.assertEqual(reader.get(code), (test_url, None))
+        self.assertEqual(reader.resolve(other_code, "localhost"), f"{test_url}other")
+        self.assertIsNone(reader.resolve(other_code, "example.com"))
+        self.assertIsNone(reader.get("zzzzzz"))
+        reader.close()
+
+        user.custom_domain = "https://example.com"
+        user.update()
+        other_url.delete()
+        new_url = Url(user_id=user.id, uuid=shortuuid.random(length=6), long_url=f"{test_url}new")
+        new_url.save()
+        result = runner.invoke(args=["snapshot", "delta", base, delta])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Wrote 3 changed codes", result.output)
+
+        reader = SnapshotReader(base, [delta], default_host="localhost")
+        self.assertEqual(reader.resolve(code, "example.com"), test_url)
+        self.assertIsNone(reader.get(other_code))
+        self.assertEqual(reader.get(new_url.uuid), (f"{test_url}new", "example.com"))
+        self.assertEqual(len(list(reader.records())), 2)
+        reader.close()
+
+    def test_snapshot_lookup_reads_the_mapped_file(self):
+        # codes longer than the 16 bytes of the index key share a key
+        codes = sorted([b"a" * 20 + suffix for suffix in [b"x", b"y", b"z"]] + [b"abc", b"b", b"zz"])
+        path = os.path.join(tempfile.mkdtemp(), "urls.snap")
+        with open(path, "wb") as f:
+            f.write(encode_records([(code, b"", test_url.encode() + code) for code in codes]))
+
+        snapshot = Snapshot(path)
+        for code in codes:
+            record = snapshot.find(code)
+            self.assertIsInstance(record[2], memoryview)
+            self.assertEqual(record[2], test_url.encode() + code)
+            del record
+        self.assertIsNone(snapshot.find(b"a" * 20))
+        self.assertIsNone(snapshot.find(b"c"))
+        self.assertEqual([record[0] for record in snapshot.records()], codes)
+        snapshot.close()
+
+    def test_redirect_rate_limit_leased_from_shared_window(self):
+        _, url = create_url()
+        for _ in range(3):
+            response = self.client.get(self.redirect.format(uuid=url.uuid), base_url=DEFAULT_DOMAIN)
+            self.assertEqual(response.status_code, 302)
+        self.assertEqual(rate_limit_leases.leased, 1)
+        self.assertEqual(rate_limit_leases.local_hits, 2)
+
+        endpoint, _ = self.app.url_map.bind("localhost").match(self.redirect.format(uuid=url.uuid))
+        _, remaining = limiter.limiter.get_window_stats(parse(REDIRECT_LIMIT), "127.0.0.1", endpoint)
+        self.assertEqual(remaining, 100 - rate_limit_leases.lease_size)
+
+    def test_rate_limit_leases_exact_near_the_limit(self):
+        allowed = 0
+        for _ in range(15):
+            # a request that cannot be leased is checked with a single hit like the limiter does
+            if rate_limit_leases.allow("12/minute", "client", "scope") or limiter.limiter.hit(
+                parse("12/minute"), "client", "scope"
+            ):
+                allowed += 1
+        self.assertEqual(allowed, 12)
+
+    def test_redirect_clicks_flushed_in_batch(self):
+        _, url = create_url()
+        for referrer in ["", "qr", "qr"]:
+            self.client.get(f"{self.redirect.format(uuid=url.uuid)}?referrer={referrer}", base_url=DEFAULT_DOMAIN)
+        db.session.refresh(url)
+        self.assertEqual(url.clicks, 0)
+        self.assertEqual(click_buffer.flush(), 3)
+        db.session.refresh(url)
+        self.assertEqual(url.clicks, 3)
+        UrlReferrerCount.attach([url])
+        self.assertEqual(url.referrers, {"Unknowns": 1, "qr": 2})
+
+    def test_delete_url_removes_click_counters(self):
+        user, url = create_url()
+        token = create_access_token(identity=user.id)
+        headers = {"Authorization": f"Bearer {token}"}
+        self.client.get(f"{self.redirect.format(uuid=url.uuid)}?referrer=qr", base_url=DEFAULT_DOMAIN)
+        click_buffer.flush()
+        db.session.add_all(
+            UrlHourlyClicks(url_id=url.id, bucket_start=datetime(2023, 1, 1, hour), clicks=1) for hour in range(24)
+        )
+        db.session.commit()
+
+        loaded = []
+
+        def listener(target, context):
+            loaded.append(target)
+
+        for model in (UrlReferrerCount, UrlHourlyClicks, UrlDailyClicks):
+            sqlalchemy.event.listen(model, "load", listener)
+            self.addCleanup(sqlalchemy.event.remove, model, "load", listener)
+        response = self.client.delete(self.one_url.format(uuid=url.uuid), headers=headers)
+        self.assertEqual(response.status_code, 204)
+        # the counters are removed with bulk deletes, without loading the url's history
+        self.assertEqual(loaded, [])
+        for model in (UrlReferrerCount, UrlHourlyClicks, UrlDailyClicks):
+            self.assertEqual(model.query.count(), 0)
+
+    def test_get_all_urls_referrers(self):
+        user, url = create_url()
+        self.client.get(f"{self.redirect.format(uuid=url.uuid)}?referrer=qr", base_url=DEFAULT_DOMAIN)
+        click_buffer.flush()
+        db.session.expire_all()
+        token = create_access_token(identity=user.id)
+        headers = {"Authorization": f"Bearer {token}"}
+        response = self.client.get(self.get_all_urls, headers=headers)
+        self.assertEqual(response.json[0]["referrer"], {"Unknowns": 0, "qr": 1})
+        self.assertEqual(response.json[0]["clicks"], 1)
+
+    def test_redirect_fail_unknown_code(self):
+        response = self.client.get(self.redirect.format(uuid="unknown"), base_url=DEFAULT_DOMAIN)
+        self.assertEqual(response.status_code, 404)
+
+    def test_redirect_unknown_codes_rejected_by_filter(self):
+        _, url = create_url()
+        code_filter.load()
+        with unittest.mock.patch.object(resolution_cache, "load") as load:
+            for code in ["zz9zz9", "notahashid"]:
+                response = self.client.get(self.redirect.format(uuid=code), base_url=DEFAULT_DOMAIN)
+                self.assertEqual(response.status_code, 404)
+            load.assert_not_called()
+        self.assertEqual(code_filter.stats()["rejected"], 2)
+
+        # codes inserted after the filter was built pass it
+        other_url = Url(user_id=url.user_id, uuid=shortuuid.random(length=6), long_url=f"{test_url}other")
+        other_url.save()
+        for code in [url.uuid, other_url.uuid]:
+            response = self.client.get(self.redirect.format(uuid=code), base_url=DEFAULT_DOMAIN)
+            self.assertEqual(response.status_code, 302)
+
+    def test_redirect_uses_updated_url(self):
+        user, url = create_url()
+        token = create_access_token(identity=user.id)
+        headers = {"Authorization": f"Bearer {token}"}
+        self.client.get(self.redirect.format(uuid=url.uuid), base_url=DEFAULT_DOMAIN)
+        self.assertIsNotNone(resolution_cache.get(url.uuid))
+        self.client.put(self.one_url.format(uuid=url.uuid), json=self.update_url_data, headers=headers)
+        response = self.client.get(self.redirect.format(uuid=url.uuid), base_url=DEFAULT_DOMAIN)
+        self.assertEqual(response.location, self.update_url_data["url"])
+
+    def test_resolution_cache_entries_expire_in_other_workers(self):
+        user, url = create_url()
+        token = create_access_token(identity=user.id)
+        headers = {"Authorization": f"Bearer {token}"}
+        other_worker = ResolutionCache(local_timeout=0.05)
+        resolution_cache.resolve(url.uuid)
+        other_worker.resolve(url.uuid)
+        self.client.put(self.one_url.format(uuid=url.uuid), json=self.update_url_data, headers=headers)
+        self.assertEqual(resolution_cache.resolve(url.uuid)["long_url"], self.update_url_data["url"])
+        time.sleep(0.1)
+        self.assertIsNone(other_worker.get(url.uuid))
+        self.assertEqual(other_worker.resolve(url.uuid)["long_url"], self.update_url_data["url"])
+
+    def test_resolution_cache_serves_stale_entry_while_reloading(self):
+        _, url = create_url()
+        worker = ResolutionCache(local_timeout=0.01, stale_timeout=60)
+        worker.resolve(url.uuid)
+        url.long_url = self.update_url_data["url"]
+        url.update()
+        time.sleep(0.02)
+        # a concurrent lookup of a code that is being reloaded gets the stale entry
+        during_reload = []
+        worker._flight.do(url.uuid, lambda: during_reload.append(worker.resolve(url.uuid)))
+        self.assertEqual(during_reload[0]["long_url"], test_url)
+        self.assertEqual(worker.stats()["stale_hits"], 1)
+        self.assertEqual(worker.resolve(url.uuid)["long_url"], self.update_url_data["url"])
+
+    def test_single_flight_coalesces_concurrent_calls(self):
+        flight = SingleFlight()
+        release = threading.Event()
+        calls, results = [], []
+
+        def compute():
+            calls.append(1)
+            release.wait(5)
+            return "value"
+
+        threads = [threading.Thread(target=lambda: results.append(flight.do("key", compute))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        deadline = time.monotonic() + 5
+        while flight.coalesced < 4 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ["value"] * 5)
+
+    def test_redirect_fail_deleted_url(self):
+        user, url = create_url()
+        token = create_access_token(identity=user.id)
+        headers = {"Authorization": f"Bearer {token}"}
+        self.client.get(self.redirect.format(uuid=url.uuid), base_url=DEFAULT_DOMAIN)
+        self.client.delete(self.one_url.format(uuid=url.uuid), headers=headers)
+        response = self.client.get(self.redirect.format(uuid=url.uuid), base_url=DEFAULT_DOMAIN)
+        self.assertEqual(response.status_code, 404)
+
+    def test_redirect_success_custom_domain(self):
+        user, url = create_url()
+        token = create_access_token(identity=user.id)
+        headers = {"Authorization": f"Bearer {token}"}
+        response = self.client.get(self.redirect.format(uuid=url.uuid), base_url="https://example.com/")
+        self.assertEqual(response.status_code, 404)
+        self.client.put("/users/update-profile", json={"custom_domain": "https://example.com"}, headers=headers)
+        response = self.client.get(self.redirect.format(uuid=url.uuid), base_url="https://example.com/")
+        self.assertEqual(response.status_code, 302)
+        self.client.put("/users/update-profile", json={"remove_custom_domain": True}, headers=headers)
+        response = self.client.get(self.redirect.format(uuid=url.uuid), base_url="https://example.com/")
+        self.assertEqual(response.status_code, 404)
+
+    def test_url_analytics_success(self):
+        user, url = create_url()
+        click_buffer.record(url.id, clicked_at=datetime(2024, 1, 1, 10, 15))
+        click_buffer.record(url.id, clicked_at=datetime(2024, 1, 1, 10, 45))
+        click_buffer.record(url.id, clicked_at=datetime(2024, 1, 2, 8, 0))
+        click_buffer.flush()
+        token = create_access_token(identity=user.id)
+        headers = {"Authorization": f"Bearer {token}"}
+        analytics_url = f"/urls/{url.uuid}/analytics"
+
+        response = self.client.get(f"{analytics_url}?from=2024-01-01&to=2024-01-03", headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["total"], 3)
+        self.assertEqual([bucket["clicks"] for bucket in response.json["buckets"]], [2, 1])
+
+        response = self.client.get(
+            f"{analytics_url}?from=2024-01-01T10:00:00&to=2024-01-01T12:00:00&granularity=hour", headers=headers
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([bucket["clicks"] for bucket in response.json["buckets"]], [2, 0])
+
+    def test_url_analytics_fail_invalid_window(self):
+        user, url = create_url()
+        token = create_access_token(identity=user.id)
+        headers = {"Authorization": f"Bearer {token}"}
+        analytics_url = f"/urls/{url.uuid}/analytics"
+        response = self.client.get(f"{analytics_url}?from=2024-01-03&to=2024-01-01", headers=headers)
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(f"{analytics_url}?from=2020-01-01&to=2024-01-01&granularity=hour", headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_get_all_urls_paginated(self):
+        user, first_url = create_url()
+        for i in range(4):
+            Url(user_id=user.id, uuid=shortuuid.random(length=6), long_url=f"{test_url}{i}", title=test_title).save()
+        token = create_access_token(identity=user.id)
+        headers = {"Authorization": f"Bearer {token}"}
+
+        response = self.client.get(f"{self.get_all_urls}?limit=2", headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json), 2)
+        self.assertEqual(response.json[0]["uuid"], first_url.uuid)
+        seen = [url["uuid"] for url in response.json]
+        cursor = response.headers["X-Next-Cursor"]
+        while cursor:
+            response = self.client.get(f"{self.get_all_urls}?limit=2&cursor={cursor}", headers=headers)
+            seen.extend(url["uuid"] for url in response.json)
+            cursor = response.headers.get("X-Next-Cursor")
+        self.assertEqual(len(seen), 5)
+        self.assertEqual(len(set(seen)), 5)
+
+    def test_get_all_urls_fields(self):
+        user, url = create_url()
+        token = create_access_token(identity=user.id)
+        headers = {"Authorization": f"Bearer {token}"}
+        response = self.client.get(f"{self.get_all_urls}?fields=uuid,short_url", headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, [{"uuid": url.uuid, "short_url": f"http://localhost/{url.uuid}"}])
+        response = self.client.get(f"{self.get_all_urls}?fields=password_hash", headers=headers)
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(f"{self.get_all_urls}?cursor=invalid", headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_shorten_url_success(self):
+        user = create_user()
+        token = create_access_token(identity=user.id)
+        headers = {"Authorization": f"Bearer {token}"}
+        data = {"url": test_url, "title": test_title}
+        response = self.client.post(self.shorten_url, json=data, headers=headers)
+        self.assertEqual(response.status_code, 201)
+        response_again = self.client.post(self.shorten_url, json=data, headers=headers)
+        self.assertEqual(response_again.status_code, 200)
+        self.assertEqual(response_again.json["uuid"], response.json["uuid"])
+
+        second_user = create_user(custom_data=second_user_data.copy())
+        token = create_access_token(identity=second_user.id)
+        headers = {"Authorization": f"Bearer {token}"}
+        response_other_user = self.client.post(self.shorten_url, json=data, headers=headers)
+        self.assertEqual(response_other_user.status_code, 201)
+        self.assertNotEqual(response_other_user.json["uuid"], response.json["uuid"])
+
+    def test_shorten_url_uses_cached_user_profile(self):
+        user = create_user()
+        headers = {"Authorization": f"Bearer {create_access_token(identity=user.id)}"}
+        response = self.client.post(self.shorten_url, json={"url": test_url, "title": test_title}, headers=headers)
+        self.assertTrue(response.json["short_url"].startswith("http://localhost/"))
+
+        # changes that do not go through the profile endpoint are not seen until the profile expires
+        user.custom_domain = "https://other.com/"
+        user.update()
+        data = {"url": f"{test_url}second", "title": test_title}
+        response = self.client.post(self.shorten_url, json=data, headers=headers)
+        self.assertTrue(response.json["short_url"].startswith("http://localhost/"))
+
+        self.client.put("/users/update-profile", json={"custom_domain": "https://example.com"}, headers=headers)
+        data = {"url": f"{test_url}third", "title": test_title}
+        response = self.client.post(self.shorten_url, json=data, headers=headers)
+        self.assertTrue(response.json["short_url"].startswith("https://example.com/"))
+
+    def test_update_url_fail_already_shortened(self):
+        user, url = create_url()
+        other_url = Url(user_id=user.id, uuid=shortuuid.random(length=6), long_url=self.update_url_data["url"])
+        other_url.save()
+        token = create_access_token(identity=user.id)
+        headers = {"Authorization": f"Bearer {token}"}
+        response = self.client.put(self.one_url.format(uuid=url.uuid), json=self.update_url_data, headers=headers)
+        self.assertEqual(response.status_code, 409)
+
+    def test_shorten_url_code_decodes_to_id(self):
+        user, _ = create_url()
+        token = create_access_token(identity=user.id)
+        headers = {"Authorization": f"Bearer {token}"}
+        codes = set()
+        for i in range(3):
+            data = {"url": f"{test_url}{i}", "title": test_title}
+            response = self.client.post(self.shorten_url, json=data, headers=headers)
+            self.assertEqual(response.status_code, 201)
+            code = response.json["uuid"]
+            url = Url.query.filter_by(uuid=code).first()
+            self.assertEqual(code_allocator.decode(code), url.id)
+            codes.add(code)
+        self.assertEqual(len(codes), 3)
+        response = self.client.get(self.redirect.format(uuid=code), base_url=DEFAULT_DOMAIN)
+        self.assertEqual(response.location, f"{test_url}2")
+
+    def test_shorten_url_does_not_reuse_deleted_code(self):
+        user, _ = create_url()
+        token = create_access_token(identity=user.id)
+        headers = {"Authorization": f"Bearer {token}"}
+        data = {"url": f"{test_url}old", "title": test_title}
+        response = self.client.post(self.shorten_url, json=data, headers=headers)
+        old_code = response.json["uuid"]
+        self.client.delete(self.one_url.format(uuid=old_code), headers=headers)
+        code_allocator.init_app(self.app)
+        data = {"url": f"{test_url}new", "title": test_title}
+        response = self.client.post(self.shorten_url, json=data, headers=headers)
+        self.assertNotEqual(response.json["uuid"], old_code)
+        response = self.client.get(self.redirect.format(uuid=old_code), base_url=DEFAULT_DOMAIN)
+        self.assertEqual(response.status_code, 404)
+
+    def test_shorten_batch_success(self):
+        user, url = create_url()
+        token = create_access_token(identity=user.id)
+        headers = {"Authorization": f"Bearer {token}"}
+        items = [
+            {"url": "https://example.com/a", "title": "A"},
+            {"url": test_url, "title": test_title},
+            {"url": "not a url", "title": "Invalid"},
+            {"url": "https://example.com/b", "title": "B"},
+            {"url": "https://example.com/a", "title": "A again"},
+        ]
+        response = self.client.post("/urls/shorten-batch", json={"urls": items}, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        results = response.json["results"]
+        self.assertEqual([result["status"] for result in results], [201, 200, 400, 201, 200])
+        self.assertEqual(results[0]["url"]["long_url"], "https://example.com/a")
+        self.assertEqual(results[1]["url"]["uuid"], url.uuid)
+        self.assertIsNone(results[2]["url"])
+        self.assertEqual(results[4]["url"]["uuid"], results[0]["url"]["uuid"])
+        self.assertEqual(Url.query.filter_by(user_id=user.id).count(), 3)
+
+    def test_shorten_batch_fail_empty(self):
+        user = create_user()
+        token = create_access_token(identity=user.id)
+        headers = {"Authorization": f"Bearer {token}"}
+        response = self.client.post("/urls/shorten-batch", json={"urls": []}, headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_export_urls_success(self):
+        user, url = create_url()
+        token = create_access_token(identity=user.id)
+        headers = {"Authorization": f"Bearer {token}"}
+        response = self.client.get("/urls/export?format=csv", headers=headers)
+        self.assertEqual(response.status_code, 200)
+        lines = response.data.decode().splitlines()
+        self.assertEqual(lines[0], "uuid,short_url,long_url,title,clicks,created_at")
+        self.assertTrue(lines[1].startswith(f"{url.uuid},http://localhost/{url.uuid},{test_url},{test_title},0,"))
+        response = self.client.get("/urls/export?format=ndjson", headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data.decode().splitlines()[0])["long_url"], test_url)
+
+    def test_import_urls_success(self):
+        user, _ = create_url()
+        token = create_access_token(identity=user.id)
+        headers = {"Authorization": f"Bearer {token}", "Content-Type": "text/csv"}
+        body = f"url,title\nhttps://example.com/a,A\n{test_url},Again\nnot a url,Bad\nhttps://example.com/b,\n"
+        response = self.client.post("/urls/import", data=body, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["created"], 2)
+        self.assertEqual(response.json["existing"], 1)
+        self.assertEqual(response.json["errors"], [{"line": 4, "message": "A valid URL is required"}])
+        self.assertEqual(Url.get_for_user(user.id, "https://example.com/b").title, "URL Title")
+
+        headers["Content-Type"] = "application/x-ndjson"
+        body = '{"url": "https://example.com/c", "title": "C"}\n{invalid\n'
+        response = self.client.post("/urls/import", data=body, headers=headers)
+        self.assertEqual(response.json["created"], 1)
+        self.assertEqual(response.json["errors"], [{"line": 2, "message": "Invalid JSON"}])
+
+    def test_import_urls_invalid_file(self):
+        user, _ = create_url()
+        token = create_access_token(identity=user.id)
+        headers = {"Authorization": f"Bearer {token}", "Content-Type": "text/csv"}
+        body = b"url,title\nhttps://example.com/a,A\nhttps://example.com/b,\xff\n"
+        response = self.client.post("/urls/import", data=body, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["errors"], [{"line": 3, "message": "Invalid UTF-8"}])
+
+        body = f"url,title\nhttps://example.com/c,{'C' * (csv.field_size_limit() + 1)}\n"
+        response = self.client.post("/urls/import", data=body, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["errors"][0]["line"], 2)
+        self.assertTrue(response.json["errors"][0]["message"].startswith("Invalid CSV"))
+
+        headers["Content-Type"] = "application/x-ndjson"
+        body = b'{"url": "https://example.com/d", "title": "\xff"}\n{"url": "https://example.com/e", "title": "E"}\n'
+        response = self.client.post("/urls/import", data=body, headers=headers)
+        self.assertEqual(response.json["created"], 1)
+        self.assertEqual(response.json["errors"], [{"line": 1, "message": "Invalid UTF-8"}])
@@ -1,3 +1,5 @@
+import os
+import tempfile
 import unittest
 
 import shortuuid
@@ -112,3 +114,24 @@ class UserProfileTestCase(unittest.TestCase):
         response = self.client.put(self.update_endpoint, headers=headers, json=data)
         self.assertEqual(response.status_code, 200)
         self.assertEqual(test_user.custom_domain, "")
+
+    def test_update_profile_rerenders_qr_codes(self):
+        user, url = create_url()
+        file_path = os.path.join(tempfile.mkdtemp(), f"{url.uuid}_qrcode.png")
+        open(file_path, "wb").close()
+        url.qr_code = file_path
+        url.has_qr_code = True
+        url.update()
+        token = create_access_token(identity=user.id)
+        headers = {"Authorization": f"Bearer {token}"}
+        response = self.client.put(self.update_endpoint, headers=headers, json=user_data.copy())
+        self.assertEqual(response.status_code, 200)
+        job_id = response.json["qr_job_id"]
+        self.assertIsNotNone(job_id)
+        response = self.client.get(f"/users/qr-jobs/{job_id}", headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["status"], "done")
+        self.assertEqual(response.json["done"], 1)
+        with open(file_path, "rb") as f:
+            self.assertEqual(f.read(8), b"\x89PNG\r\n\x1a\n")
+        os.remove(file_path)
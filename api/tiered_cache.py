@@ -0,0 +1,177 @@
+import threading
+import time
+from collections import OrderedDict
+
+from flask_caching.backends.base import BaseCache
+from werkzeug.utils import import_string
+
+
+class TieredCache(BaseCache):
+    """flask-caching backend with a small in-process LRU (L1) in front of a shared cache (L2)
+
+    Reads are answered by L1 while its entry is fresh and are promoted from L2
+    into L1 on an L1 miss. Writes go to both tiers. L1 entries live at most
+    `l1_timeout` seconds since other workers cannot invalidate them; keys
+    starting with one of `l1_skip_prefixes` must always be current and are
+    only kept in L2. Entries leaving L1 because it is full or because they
+    expired are counted as demotions.
+
+    Configured with CACHE_TYPE = "api.tiered_cache.TieredCache":
+        CACHE_L2_TYPE: import path of the flask-caching backend used as L2
+        CACHE_L1_SIZE: number of entries kept in L1
+        CACHE_L1_TIMEOUT: seconds an entry is kept in L1
+        CACHE_L1_SKIP_PREFIXES: key prefixes that bypass L1
+    """
+
+    def __init__(self, l2, l1_size=1024, l1_timeout=5, l1_skip_prefixes=(), default_timeout=300):
+        super().__init__(default_timeout=default_timeout)
+        self.l2 = l2
+        self.l1_size = l1_size
+        self.l1_timeout = l1_timeout
+        self.l1_skip_prefixes = tuple(l1_skip_prefixes)
+        self._l1 = OrderedDict()
+        self._lock = threading.Lock()
+        self.l1_hits = 0
+        self.l2_hits = 0
+        self.misses = 0
+        self.promotions = 0
+        self.demotions = 0
+
+    @classmethod
+    def factory(cls, app, config, args, kwargs):
+        l2_class = import_string(config.get("CACHE_L2_TYPE", "flask_caching.backends.RedisCache"))
+        l2 = l2_class.factory(app, config, list(args), dict(kwargs))
+        return cls(
+            l2,
+            l1_size=config.get("CACHE_L1_SIZE", 1024),
+            l1_timeout=config.get("CACHE_L1_TIMEOUT", 5),
+            l1_skip_prefixes=config.get("CACHE_L1_SKIP_PREFIXES", ()),
+            default_timeout=kwargs.get("default_timeout", 300),
+        )
+
+    def _uses_l1(self, key):
+        return self.l1_size > 0 and not key.startswith(self.l1_skip_prefixes)
+
+    def _get_l1(self, key):
+        with self._lock:
+            item = self._l1.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at <= time.monotonic():
+                del self._l1[key]
+                self.demotions += 1
+                return None
+            self._l1.move_to_end(key)
+            return item
+
+    def _set_l1(self, key, value, timeout=None):
+        if not self._uses_l1(key):
+            return
+        timeout = self._normalize_timeout(timeout)
+        l1_timeout = min(timeout, self.l1_timeout) if timeout > 0 else self.l1_timeout
+        with self._lock:
+            self._l1[key] = (time.monotonic() + l1_timeout, value)
+            self._l1.move_to_end(key)
+            while len(self._l1) > self.l1_size:
+                self._l1.popitem(last=False)
+                self.demotions += 1
+
+    def _delete_l1(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._l1.pop(key, None)
+
+    def get(self, key):
+        item = self._get_l1(key) if self._uses_l1(key) else None
+        if item is not None:
+            self.l1_hits += 1
+            return item[1]
+
+        value = self.l2.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.l2_hits += 1
+        if self._uses_l1(key):
+            self.promotions += 1
+            self._set_l1(key, value)
+        return value
+
+    def get_many(self, *keys):
+        values = {}
+        missing = []
+        for key in keys:
+            item = self._get_l1(key) if self._uses_l1(key) else None
+            if item is not None:
+                self.l1_hits += 1
+                values[key] = item[1]
+            else:
+                missing.append(key)
+        if missing:
+            for key, value in zip(missing, self.l2.get_many(*missing)):
+                if value is None:
+                    self.misses += 1
+                    continue
+                self.l2_hits += 1
+                if self._uses_l1(key):
+                    self.promotions += 1
+                    self._set_l1(key, value)
+                values[key] = value
+        return [values.get(key) for key in keys]
+
+    def set(self, key, value, timeout=None):
+        result = self.l2.set(key, value, timeout=timeout)
+        self._set_l1(key, value, timeout)
+        return result
+
+    def add(self, key, value, timeout=None):
+        added = self.l2.add(key, value, timeout=timeout)
+        if added:
+            self._set_l1(key, value, timeout)
+        return added
+
+    def set_many(self, mapping, timeout=None):
+        result = self.l2.set_many(mapping, timeout=timeout)
+        for key, value in mapping.items():
+            self._set_l1(key, value, timeout)
+        return result
+
+    def delete(self, key):
+        self._delete_l1(key)
+        return self.l2.delete(key)
+
+    def delete_many(self, *keys):
+        self._delete_l1(*keys)
+        return self.l2.delete_many(*keys)
+
+    def has(self, key):
+        if self._uses_l1(key) and self._get_l1(key) is not None:
+            return True
+        return self.l2.has(key)
+
+    def clear(self):
+        with self._lock:
+            self._l1.clear()
+        return self.l2.clear()
+
+    def inc(self, key, delta=1):
+        self._delete_l1(key)
+        return self.l2.inc(key, delta=delta)
+
+    def dec(self, key, delta=1):
+        self._delete_l1(key)
+        return self.l2.dec(key, delta=delta)
+
+    def stats(self):
+        lookups = self.l1_hits + self.l2_hits + self.misses
+        return {
+            "l1_size": len(self._l1),
+            "l1_maxsize": self.l1_size,
+            "l1_hits": self.l1_hits,
+            "l2_hits": self.l2_hits,
+            "misses": self.misses,
+            "promotions": self.promotions,
+            "demotions": self.demotions,
+            "l1_hit_rate": round(self.l1_hits / lookups, 4) if lookups else 0.0,
+        }
@@ -1,24 +1,34 @@
+import csv
+import io
 import json
 import os
+from datetime import datetime, timedelta, timezone
 from http import HTTPStatus
 
-import qrcode
-import shortuuid
 import validators
 from decouple import config
-from flask import redirect, request, send_file
+from flask import Response, current_app, redirect, request, send_file, stream_with_context
 from flask_jwt_extended import get_jwt_identity, jwt_required
-from flask_restx import Namespace, Resource, abort, fields
-
-from api.config import BASE_DIR
-from api.models import DeletedUrl, Url, User
-from api.utils import cache, db, limiter, convert_referrer
+from flask_restx import Namespace, Resource, abort, fields, marshal
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import load_only
+
+from api.clicks import click_buffer
+from api.code_filter import code_filter
+from api.codes import code_allocator
+from api.domains import domain_registry
+from api.models import DeletedUrl, Url, UrlDailyClicks, UrlHourlyClicks, UrlReferrerCount
+from api.qr import QR_FORMATS, qr_cache, qr_payload, zip_qr_codes
+from api.rate_limits import rate_limit_leases
+from api.resolution import resolution_cache
+from api.response_cache import response_cache
+from api.user_context import user_context
+from api.utils import cache, db, limiter, paginate_keyset, write_file
 
 DEFAULT_DOMAIN = config("DEFAULT_DOMAIN")
-
-# Get the directory where qr code images will be stored
-script_dir = os.path.dirname(os.path.abspath(__file__))
-qr_codes_dir = f"{os.path.dirname(BASE_DIR)}\\frontend\\public\\qr_codes"
+# limits of the hottest routes, checked against local leases of the shared window
+SHORTEN_LIMIT = "100/minute"
+REDIRECT_LIMIT = "100/minute"
 
 
 url_namespace = Namespace("Url", description="urls namespace")
@@ -52,7 +62,7 @@ url_output = url_namespace.model(
         "created_at": fields.DateTime(),
         "updated_at": fields.DateTime(),
         "clicks": fields.Integer(),
-        "referrer": fields.Raw(),
+        "referrer": fields.Raw(attribute="referrers"),
         "qr_code": fields.String(),
         "has_qr_code": fields.Boolean(),
     },
@@ -68,6 +78,77 @@ deleted_url_output = url_namespace.model(
     },
 )
 
+url_batch_item = url_namespace.model(
+    "Shorten Url Batch Item",
+    {
+        "url": fields.String(required=True, description="url to shorten"),
+        "title": fields.String(required=True, description="title of the url"),
+    },
+)
+
+url_batch_input = url_namespace.model(
+    "Shorten Url Batch",
+    {
+        "urls": fields.List(fields.Nested(url_batch_item), required=True),
+    },
+)
+
+url_batch_result = url_namespace.model(
+    "Shorten Url Batch Result",
+    {
+        "status": fields.Integer(description="201 created, 200 already shortened or 400 invalid"),
+        "message": fields.String(),
+        "url": fields.Nested(url_output, allow_null=True, skip_none=True),
+    },
+)
+
+url_batch_output = url_namespace.model(
+    "Shorten Url Batch Output",
+    {
+        "results": fields.List(fields.Nested(url_batch_result)),
+    },
+)
+
+analytics_bucket = url_namespace.model(
+    "Analytics Bucket",
+    {
+        "start": fields.DateTime(),
+        "clicks": fields.Integer(),
+    },
+)
+
+analytics_output = url_namespace.model(
+    "Analytics Output",
+    {
+        "uuid": fields.String(),
+        "granularity": fields.String(),
+        "from": fields.DateTime(),
+        "to": fields.DateTime(),
+        "total": fields.Integer(),
+        "buckets": fields.List(fields.Nested(analytics_bucket)),
+    },
+)
+
+# granularity: (rollup model, bucket width, largest window that can be requested)
+analytics_granularities = {
+    "hour": (UrlHourlyClicks, timedelta(hours=1), timedelta(days=31)),
+    "day": (UrlDailyClicks, timedelta(days=1), timedelta(days=366 * 3)),
+}
+
+
+def parse_datetime_arg(name, default):
+    """Parse an ISO 8601 query argument into a naive UTC datetime"""
+    value = request.args.get(name)
+    if not value:
+        return default
+    try:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        abort(HTTPStatus.BAD_REQUEST, f"{name} should be an ISO 8601 date or datetime")
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
 
 @url_namespace.route("/shorten-url")
 class ShortenUrl(Resource):
@@ -75,9 +156,9 @@ class ShortenUrl(Resource):
     Accepts [POST] requests
     Returns a serialized URL object
     """
-    @limiter.limit("100/minute")
-    @cache.cached(timeout=60)
+    @limiter.limit(SHORTEN_LIMIT, exempt_when=rate_limit_leases.exempt_when(SHORTEN_LIMIT))
     @jwt_required()
+    @response_cache.invalidates
     @url_namespace.expect(url_input)
     @url_namespace.marshal_with(url_output)
     def post(self):
@@ -85,7 +166,7 @@ class ShortenUrl(Resource):
         data: dict = request.get_json()
         url = data.get("url")
         title = data.get("title")
-        user_domain = User.query.filter_by(id=user).first().custom_domain
+        user_domain = user_context.current().custom_domain
 
         domain = f"{user_domain}" if user_domain else request.host_url
 
@@ -95,58 +176,390 @@ class ShortenUrl(Resource):
         if not title or len(title) > 20:
             abort(HTTPStatus.BAD_REQUEST, "Title is required and should not be longer than 10 characters")
 
-        existing_urls = Url.query.filter_by(long_url=url).all()
+        existing_url = Url.get_for_user(user, url)
+
+        if existing_url:
+            UrlReferrerCount.attach([existing_url])
+            existing_url.short_url = f"{domain}{existing_url.uuid}"
+            return existing_url, HTTPStatus.OK
+
+        new_url = code_allocator.assign(Url(user_id=user, long_url=url, title=title))
+        try:
+            new_url.save()
+        except IntegrityError:
+            # a concurrent request shortened the same url first
+            db.session.rollback()
+            existing_url = Url.get_for_user(user, url)
+            if existing_url is None:
+                raise
+            UrlReferrerCount.attach([existing_url])
+            existing_url.short_url = f"{domain}{existing_url.uuid}"
+            return existing_url, HTTPStatus.OK
+
+        UrlReferrerCount.attach([new_url])
+        new_url.short_url = f"{domain}{new_url.uuid}"
+        return new_url, HTTPStatus.CREATED
 
-        for s_url in existing_urls:
-            if s_url.user_id == user:
-                s_url.short_url = f"{domain}{s_url.uuid}"
-                return s_url, HTTPStatus.OK
 
-        short_url = shortuuid.random(length=6)
+def validate_url_item(item):
+    """Return the error message of an item of a shorten batch, or None when the item is valid"""
+    if not isinstance(item, dict):
+        return "Every item should be an object with a url and a title"
+    url = item.get("url")
+    title = item.get("title")
+    if not url or not isinstance(url, str) or not validators.url(url, public=True):
+        return "A valid URL is required"
+    if not title or not isinstance(title, str) or len(title) > 20:
+        return "Title is required and should not be longer than 20 characters"
+    return None
+
+
+def existing_urls_by_hash(user_id, long_url_hashes, chunk_size=500):
+    """Find the urls a user already shortened among long_url_hashes with one query per chunk"""
+    hashes = list(long_url_hashes)
+    found = {}
+    for start in range(0, len(hashes), chunk_size):
+        urls = Url.query.filter(
+            Url.user_id == user_id, Url.long_url_hash.in_(hashes[start:start + chunk_size])
+        ).all()
+        found.update((url.long_url_hash, url) for url in urls)
+    return found
+
+
+def insert_new_urls(user_id, items):
+    """Insert the items a user has not shortened yet in a single transaction
+
+    Args:
+        user_id: int
+        items: list of (long_url, title) tuples, items with the same long_url are inserted once
+    Return: ({long_url_hash: Url}, set of the hashes that were inserted)
+    """
 
-        new_url = Url(user_id=user, uuid=short_url, long_url=url, title=title)
-        new_url.referrer = json.dumps({"Unknowns": 0})
-        new_url.save()
+    for attempt in range(2):
+        by_hash = {}
+        for long_url, title in items:
+            by_hash.setdefault(Url.hash_long_url(long_url), (long_url, title))
+        urls = existing_urls_by_hash(user_id, by_hash)
+        new_urls = [
+            code_allocator.assign(Url(user_id=user_id, long_url=long_url, title=title))
+            for long_url_hash, (long_url, title) in by_hash.items()
+            if long_url_hash not in urls
+        ]
+        created = {url.long_url_hash for url in new_urls}
+        try:
+            db.session.add_all(new_urls)
+            db.session.commit()
+        except IntegrityError:
+            # a concurrent request shortened some of the urls first, look them up again
+            db.session.rollback()
+            if attempt:
+                raise
+            continue
+        # reload every url expired by the commit with one query per chunk instead of one per url
+        return existing_urls_by_hash(user_id, by_hash), created
+
+
+@url_namespace.route("/shorten-batch")
+class ShortenUrlBatch(Resource):
+    """Shorten many URLs at once
+    Accepts [POST] requests with a list of urls and titles
+    Returns a result for every item in the order of the input
+    """
+    @limiter.limit("10/minute")
+    @jwt_required()
+    @response_cache.invalidates
+    @url_namespace.expect(url_batch_input)
+    @url_namespace.marshal_with(url_batch_output)
+    def post(self):
+        user = get_jwt_identity()
+        data: dict = request.get_json()
+        items = data.get("urls") if isinstance(data, dict) else None
+        max_size = current_app.config.get("SHORTEN_BATCH_MAX_SIZE", 1000)
 
-        new_url.short_url = f"{domain}{short_url}"
-        return new_url, HTTPStatus.CREATED
+        if not isinstance(items, list) or not items:
+            abort(HTTPStatus.BAD_REQUEST, "A list of urls is required")
+
+        if len(items) > max_size:
+            abort(HTTPStatus.BAD_REQUEST, f"At most {max_size} urls can be shortened at once")
+
+        errors = [validate_url_item(item) for item in items]
+        valid_items = [(item["url"], item["title"]) for item, error in zip(items, errors) if error is None]
+        urls, created = insert_new_urls(user, valid_items) if valid_items else ({}, set())
+
+        user_domain = user_context.current().custom_domain
+        domain = f"{user_domain}" if user_domain else request.host_url
+        UrlReferrerCount.attach(list(urls.values()))
+        for url in urls.values():
+            url.short_url = f"{domain}{url.uuid}"
+
+        results = []
+        for item, error in zip(items, errors):
+            if error:
+                results.append({"status": HTTPStatus.BAD_REQUEST, "message": error, "url": None})
+                continue
+            url = urls[Url.hash_long_url(item["url"])]
+            status = HTTPStatus.CREATED if url.long_url_hash in created else HTTPStatus.OK
+            # only the first item of a url repeated in the batch reports it as created
+            created.discard(url.long_url_hash)
+            results.append({"status": status, "message": None, "url": url})
+        return {"results": results}, HTTPStatus.OK
+
+
+export_columns = ["uuid", "short_url", "long_url", "title", "clicks", "created_at"]
+
+
+def export_rows(user_id, domain, chunk_size):
+    """Yield the export fields of every url of a user, reading chunk_size rows at a time"""
+    query = (
+        db.select(Url.uuid, Url.long_url, Url.title, Url.clicks, Url.created_at)
+        .where(Url.user_id == user_id)
+        .order_by(Url.id)
+        .execution_options(yield_per=chunk_size)
+    )
+    for row in db.session.execute(query):
+        yield {
+            "uuid": row.uuid,
+            "short_url": f"{domain}{row.uuid}",
+            "long_url": row.long_url,
+            "title": row.title,
+            "clicks": row.clicks or 0,
+            "created_at": row.created_at.isoformat() if row.created_at else None,
+        }
+
+
+def csv_chunks(rows, chunk_size):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=export_columns)
+    writer.writeheader()
+    for count, row in enumerate(rows, start=1):
+        writer.writerow(row)
+        if count % chunk_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def ndjson_chunks(rows, chunk_size):
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(row))
+        if len(lines) == chunk_size:
+            yield "\n".join(lines) + "\n"
+            lines = []
+    if lines:
+        yield "\n".join(lines) + "\n"
+
+
+export_formats = {
+    "csv": ("text/csv", csv_chunks),
+    "ndjson": ("application/x-ndjson", ndjson_chunks),
+}
+
+
+@url_namespace.route("/export")
+class ExportUrls(Resource):
+    """Export all shortened URLs
+    Accepts [GET] requests with a format query argument (csv or ndjson)
+    Returns a streamed file with one row per URL
+    """
+    @limiter.limit("10/minute")
+    @jwt_required()
+    def get(self):
+        user = get_jwt_identity()
+        export_format = request.args.get("format", "csv")
+        if export_format not in export_formats:
+            abort(HTTPStatus.BAD_REQUEST, "format should be csv or ndjson")
+        mimetype, chunks = export_formats[export_format]
+        chunk_size = current_app.config.get("EXPORT_CHUNK_SIZE", 500)
+
+        user_domain = user_context.current().custom_domain
+        domain = f"{user_domain}" if user_domain else request.host_url
+
+        rows = export_rows(user, domain, chunk_size)
+        return Response(
+            stream_with_context(chunks(rows, chunk_size)),
+            mimetype=mimetype,
+            headers={"Content-Disposition": f"attachment; filename=urls.{export_format}"},
+        )
+
+
+def import_items(stream, mimetype):
+    """Parse an uploaded csv or ndjson file one line at a time
+
+    Yields: (line number, item or None, error message or None)
+    A csv file that cannot be decoded or parsed stops at the failing line
+    """
+
+    if mimetype == "application/x-ndjson":
+        for line_number, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                line = line.decode("utf-8")
+            except UnicodeDecodeError:
+                yield line_number, None, "Invalid UTF-8"
+                continue
+            try:
+                yield line_number, json.loads(line), None
+            except ValueError:
+                yield line_number, None, "Invalid JSON"
+    else:
+        # lines are decoded one at a time so a decoding error is reported on its own line
+        reader = csv.DictReader(line.decode("utf-8") for line in stream)
+        try:
+            for row in reader:
+                yield reader.line_num, row, None
+        except UnicodeDecodeError:
+            yield reader.line_num + 1, None, "Invalid UTF-8"
+        except csv.Error as e:
+            yield reader.line_num + 1, None, f"Invalid CSV: {e}"
+
+
+@url_namespace.route("/import")
+class ImportUrls(Resource):
+    """Import URLs from a csv or ndjson file
+    Accepts [POST] requests with a text/csv or application/x-ndjson body of url and title columns
+    Returns the number of created, existing and invalid rows
+    """
+    @limiter.limit("10/minute")
+    @jwt_required()
+    @response_cache.invalidates
+    def post(self):
+        user = get_jwt_identity()
+        batch_size = current_app.config.get("IMPORT_BATCH_SIZE", 500)
+        max_errors = 100
+        summary = {"created": 0, "existing": 0, "invalid": 0, "errors": []}
+
+        def save(batch):
+            _, created = insert_new_urls(user, batch)
+            summary["created"] += len(created)
+            summary["existing"] += len(batch) - len(created)
+
+        batch = []
+        for line_number, item, error in import_items(request.stream, request.mimetype):
+            if error is None:
+                if isinstance(item, dict) and not item.get("title"):
+                    item["title"] = Url.title.default.arg
+                error = validate_url_item(item)
+            if error:
+                summary["invalid"] += 1
+                if len(summary["errors"]) < max_errors:
+                    summary["errors"].append({"line": line_number, "message": error})
+                continue
+            batch.append((item["url"], item["title"]))
+            if len(batch) == batch_size:
+                save(batch)
+                batch = []
+        if batch:
+            save(batch)
+        return summary, HTTPStatus.OK
+
+
+def page_args():
+    """Read the limit and cursor query arguments of a listing"""
+    default_size = current_app.config.get("URLS_PAGE_SIZE", 100)
+    max_size = current_app.config.get("URLS_MAX_PAGE_SIZE", 1000)
+    try:
+        limit = int(request.args.get("limit", default_size))
+    except ValueError:
+        abort(HTTPStatus.BAD_REQUEST, "limit should be a number")
+    if not 0 < limit <= max_size:
+        abort(HTTPStatus.BAD_REQUEST, f"limit should be between 1 and {max_size}")
+    return limit, request.args.get("cursor")
+
+
+def fields_arg(output_model):
+    """Read the comma separated fields query argument of a listing
+    Return: the requested subset of output_model, or output_model when no fields were requested
+    """
+    requested = request.args.get("fields")
+    if not requested:
+        return output_model
+    names = [name.strip() for name in requested.split(",") if name.strip()]
+    unknown = [name for name in names if name not in output_model]
+    if unknown:
+        abort(HTTPStatus.BAD_REQUEST, f"Unknown fields: {', '.join(unknown)}")
+    return {name: output_model[name] for name in names}
+
+
+def page_response(items, output_fields, next_cursor):
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else {}
+    return marshal(items, output_fields), HTTPStatus.OK, headers
+
+
+# columns to load for every field of url_output, id and created_at are always loaded for the cursor
+url_output_columns = {
+    "uuid": [Url.uuid],
+    "short_url": [Url.uuid],
+    "long_url": [Url.long_url],
+    "title": [Url.title],
+    "created_at": [],
+    "updated_at": [Url.updated_at],
+    "clicks": [Url.clicks],
+    "referrer": [],
+    "qr_code": [Url.qr_code],
+    "has_qr_code": [Url.has_qr_code],
+}
 
 
 @url_namespace.route("/all-urls")
 class AllUrls(Resource):
     """Get all shortened URLs
-    Accepts [GET] requests
-    Returns multiple serialized URL objects
+    Accepts [GET] requests with optional limit, cursor and fields query arguments
+    Returns a page of serialized URL objects, the cursor of the next page is sent in the X-Next-Cursor header
     """
     @limiter.limit("10/minute")
-    @cache.cached(timeout=60)
     @jwt_required()
-    @url_namespace.marshal_list_with(url_output)
+    @response_cache.cached(timeout=60, stale_timeout=30)
+    @url_namespace.response(HTTPStatus.OK, "Success", [url_output])
     def get(self):
         user = get_jwt_identity()
-        user_domain = User.query.filter_by(id=user).first().custom_domain
-        domain = f"{user_domain}" if user_domain else request.host_url
-        urls = Url.query.filter_by(user_id=user).all()
-        for url in urls:
-            convert_referrer(url)
-            url.short_url = f"{domain}{url.uuid}"
-        return urls, HTTPStatus.OK
+        limit, cursor = page_args()
+        output_fields = fields_arg(url_output)
+
+        columns = {Url.id, Url.created_at}
+        for name in output_fields:
+            columns.update(url_output_columns[name])
+        query = Url.query.filter_by(user_id=user).options(load_only(*columns))
+        try:
+            urls, next_cursor = paginate_keyset(query, Url.created_at, Url.id, cursor, limit)
+        except ValueError:
+            abort(HTTPStatus.BAD_REQUEST, "Invalid cursor")
+
+        if "referrer" in output_fields:
+            UrlReferrerCount.attach(urls)
+        if "short_url" in output_fields:
+            user_domain = user_context.current().custom_domain
+            domain = f"{user_domain}" if user_domain else request.host_url
+            for url in urls:
+                url.short_url = f"{domain}{url.uuid}"
+        return page_response(urls, output_fields, next_cursor)
 
 
 @url_namespace.route("/deleted-urls")
 class DeletedUrls(Resource):
     """Get all deleted URLs
-    Accepts [GET] requests
-    Returns multiple serialized Deleted URL objects
+    Accepts [GET] requests with optional limit, cursor and fields query arguments
+    Returns a page of serialized Deleted URL objects, the cursor of the next page is sent in the X-Next-Cursor header
     """
     @limiter.limit("10/minute")
-    @cache.cached(timeout=60)
     @jwt_required()
-    @url_namespace.marshal_list_with(deleted_url_output)
+    @response_cache.cached(timeout=60)
+    @url_namespace.response(HTTPStatus.OK, "Success", [deleted_url_output])
     def get(self):
         user = get_jwt_identity()
-        urls = DeletedUrl.query.filter_by(user_id=user).all()
-        return urls, HTTPStatus.OK
+        limit, cursor = page_args()
+        output_fields = fields_arg(deleted_url_output)
+
+        columns = {DeletedUrl.id, DeletedUrl.deleted_at}
+        columns.update(getattr(DeletedUrl, name) for name in output_fields)
+        query = DeletedUrl.query.filter_by(user_id=user).options(load_only(*columns))
+        try:
+            urls, next_cursor = paginate_keyset(query, DeletedUrl.deleted_at, DeletedUrl.id, cursor, limit)
+        except ValueError:
+            abort(HTTPStatus.BAD_REQUEST, "Invalid cursor")
+        return page_response(urls, output_fields, next_cursor)
 
 
 @url_namespace.route("/restore-url/<int:id>")
@@ -156,8 +569,8 @@ class RestoreDeletedUrl(Resource):
     Returns a serialized URL object
     """
     @limiter.limit("10/minute")
-    @cache.cached(timeout=60)
     @jwt_required()
+    @response_cache.invalidates
     @url_namespace.marshal_with(url_output)
     def get(self, id):
         user = get_jwt_identity()
@@ -166,7 +579,7 @@ class RestoreDeletedUrl(Resource):
         if not url_to_restore or url_to_restore.user_id != user:
             abort(HTTPStatus.NOT_FOUND, "Not Found")
 
-        user_domain = User.query.filter_by(id=user).first().custom_domain
+        user_domain = user_context.current().custom_domain
         domain = f"{user_domain}" if user_domain else request.host_url
 
         if not url_to_restore or not validators.url(url_to_restore.long_url, public=True):
@@ -174,20 +587,18 @@ class RestoreDeletedUrl(Resource):
 
         url_to_restore.delete()
 
-        existing_urls = Url.query.filter_by(long_url=url_to_restore.long_url).all()
-
-        for s_url in existing_urls:
-            if s_url.user_id == user:
-                s_url.short_url = f"{domain}{s_url.uuid}"
-                return s_url, HTTPStatus.OK
+        existing_url = Url.get_for_user(user, url_to_restore.long_url)
 
-        short_url = shortuuid.random(length=6)
+        if existing_url:
+            UrlReferrerCount.attach([existing_url])
+            existing_url.short_url = f"{domain}{existing_url.uuid}"
+            return existing_url, HTTPStatus.OK
 
-        new_url = Url(user_id=user, uuid=short_url, long_url=url_to_restore.long_url)
-        new_url.referrer = json.dumps({"Unknowns": 0})
+        new_url = code_allocator.assign(Url(user_id=user, long_url=url_to_restore.long_url))
         new_url.save()
 
-        new_url.short_url = f"{domain}{short_url}"
+        UrlReferrerCount.attach([new_url])
+        new_url.short_url = f"{domain}{new_url.uuid}"
         return new_url, HTTPStatus.CREATED
 
 
@@ -198,29 +609,29 @@ class Urls(Resource):
     Returns a serialized URL object
     """
     @limiter.limit("10/minute")
-    @cache.cached(timeout=60)
     @jwt_required()
+    @response_cache.cached(timeout=60)
     @url_namespace.marshal_list_with(url_output)
     def get(self, uuid):
         user = get_jwt_identity()
-        user_domain = User.query.filter_by(id=user).first().custom_domain
+        user_domain = user_context.current().custom_domain
         domain = f"{user_domain}" if user_domain else request.host_url
         url = Url.query.filter_by(uuid=uuid).first_or_404(description="URL Not Found")
 
         if url.user_id != user:
             abort(HTTPStatus.NOT_FOUND, "URL Not Found")
-        convert_referrer(url)
+        UrlReferrerCount.attach([url])
         url.short_url = f"{domain}{url.uuid}"
         return url, HTTPStatus.OK
 
     @limiter.limit("10/minute")
-    @cache.cached(timeout=10)
     @jwt_required()
+    @response_cache.invalidates
     @url_namespace.marshal_list_with(url_output)
     @url_namespace.expect(url_input_update)
     def put(self, uuid):
         user = get_jwt_identity()
-        user_domain = User.query.filter_by(id=user).first().custom_domain
+        user_domain = user_context.current().custom_domain
         domain = f"{user_domain}" if user_domain else request.host_url
         url_to_update = Url.query.filter_by(uuid=uuid).first_or_404(description="URL Not Found")
 
@@ -234,17 +645,21 @@ class Urls(Resource):
         if new_url and not validators.url(new_url, public=True):
             abort(HTTPStatus.BAD_REQUEST, "A valid URL is required")
 
+        if new_url and new_url != url_to_update.long_url and Url.get_for_user(user, new_url):
+            abort(HTTPStatus.CONFLICT, "You have already shortened this URL")
+
         url_to_update.long_url = new_url if new_url else url_to_update.long_url
         url_to_update.title = new_title if new_title else url_to_update.title
         url_to_update.update()
+        resolution_cache.invalidate(url_to_update.uuid)
 
-        convert_referrer(url_to_update)
+        UrlReferrerCount.attach([url_to_update])
         url_to_update.short_url = f"{domain}{url_to_update.uuid}"
         return url_to_update, HTTPStatus.OK
 
     @limiter.limit("10/minute")
-    @cache.cached(timeout=60)
     @jwt_required()
+    @response_cache.invalidates
     def delete(self, uuid):
         user = get_jwt_identity()
         url_to_delete = Url.query.filter_by(uuid=uuid).first_or_404(description="URL Not Found")
@@ -257,42 +672,168 @@ class Urls(Resource):
         deleted_url = DeletedUrl(user_id=user, long_url=url_to_delete.long_url, created_at=url_to_delete.created_at)
         deleted_url.save()
         url_to_delete.delete()
+        resolution_cache.invalidate(uuid)
         return "", HTTPStatus.NO_CONTENT
 
 
+@url_namespace.route("/<string:uuid>/analytics")
+class UrlAnalytics(Resource):
+    """Get the clicks of a URL over time
+    Accepts [GET] requests with from, to and granularity (hour or day) query arguments
+    Returns the click count of every bucket in the window
+    """
+    @limiter.limit("30/minute")
+    @jwt_required()
+    @url_namespace.marshal_with(analytics_output)
+    def get(self, uuid):
+        user = get_jwt_identity()
+        url = Url.query.filter_by(uuid=uuid).first_or_404(description="URL Not Found")
+
+        if url.user_id != user:
+            abort(HTTPStatus.NOT_FOUND, "URL Not Found")
+
+        granularity = request.args.get("granularity", "day")
+        if granularity not in analytics_granularities:
+            abort(HTTPStatus.BAD_REQUEST, "granularity should be hour or day")
+        model, width, max_window = analytics_granularities[granularity]
+
+        end = parse_datetime_arg("to", datetime.utcnow())
+        start = parse_datetime_arg("from", end - timedelta(days=7))
+        if start >= end:
+            abort(HTTPStatus.BAD_REQUEST, "from should be before to")
+        if end - start > max_window:
+            abort(HTTPStatus.BAD_REQUEST, f"The window is limited to {max_window.days} days for {granularity}s")
+
+        first_bucket = start.replace(minute=0, second=0, microsecond=0)
+        if granularity == "day":
+            first_bucket = first_bucket.replace(hour=0)
+
+        rows = (
+            db.session.query(model.bucket_start, model.clicks)
+            .filter(model.url_id == url.id, model.bucket_start >= first_bucket, model.bucket_start < end)
+            .all()
+        )
+        clicks = {bucket_start: count for bucket_start, count in rows}
+
+        buckets = []
+        bucket = first_bucket
+        while bucket < end:
+            buckets.append({"start": bucket, "clicks": clicks.get(bucket, 0)})
+            bucket += width
+
+        return {
+            "uuid": url.uuid,
+            "granularity": granularity,
+            "from": start,
+            "to": end,
+            "total": sum(clicks.values()),
+            "buckets": buckets,
+        }, HTTPStatus.OK
+
+
+@url_namespace.route("/cache-stats")
+class CacheStats(Resource):
+    """Get hit/miss counters of the in-process caches
+    Accepts [GET] requests
+    Returns the counters of this worker
+    """
+    @jwt_required()
+    def get(self):
+        stats = {
+            "resolution": resolution_cache.stats(),
+            "qr": qr_cache.stats(),
+            "code_filter": code_filter.stats(),
+            "rate_limits": rate_limit_leases.stats(),
+        }
+        if hasattr(cache.cache, "stats"):
+            stats["response"] = cache.cache.stats()
+        if "redirect_middleware" in current_app.extensions:
+            stats["redirects"] = current_app.extensions["redirect_middleware"].stats()
+        return stats, HTTPStatus.OK
+
+
+def qr_format_args():
+    """Read the format and size query arguments of a QR code download"""
+    fmt = request.args.get("format", "png")
+    if fmt not in QR_FORMATS:
+        abort(HTTPStatus.BAD_REQUEST, f"format should be one of {', '.join(QR_FORMATS)}")
+    size = request.args.get("size")
+    if size is None:
+        return fmt, None
+    max_size = current_app.config.get("QR_MAX_SIZE", 2048)
+    try:
+        size = int(size)
+    except ValueError:
+        abort(HTTPStatus.BAD_REQUEST, "size should be a number")
+    if not 64 <= size <= max_size:
+        abort(HTTPStatus.BAD_REQUEST, f"size should be between 64 and {max_size}")
+    return fmt, size
+
+
 @url_namespace.route("/generate-qr-code/<string:uuid>")
 class GenerateQRCode(Resource):
     """Generate a QR Code for a URL
-    Accepts [GET] requests
+    Accepts [GET] requests with optional format (png or svg) and size (width in pixels, rounded down to a power of 2)
+    arguments, answers 304 when If-None-Match has the ETag of the current QR code
     """
     @limiter.limit("10/minute")
     @jwt_required()
     def get(self, uuid):
-        session = db.session
         user_id = get_jwt_identity()
-        user = session.get(User, user_id)
         url = Url.query.filter_by(uuid=uuid).first_or_404(description="URL Not Found")
-        custom_domain = user.custom_domain
+        custom_domain = user_context.current().custom_domain
         domain = custom_domain if custom_domain else request.host_url
 
         if url.user_id != user_id:
             abort(HTTPStatus.NOT_FOUND, "URL Not Found")
 
-        if url.qr_code:
-            file_path = url.qr_code
-        else:
-            file_path = f"{qr_codes_dir}\\{uuid}_qrcode.png"
+        fmt, size = qr_format_args()
+        payload = qr_payload(domain, uuid)
+        etag = qr_cache.key(payload, fmt, size)
+        if request.if_none_match.contains(etag):
+            return Response(status=HTTPStatus.NOT_MODIFIED, headers={"ETag": f'"{etag}"'})
+
+        _, image = qr_cache.get(payload, fmt, size)
+
+        # the frontend shows the default QR code from a file named after the code
+        file_path = os.path.join(current_app.config["QR_CODE_PUBLIC_DIRECTORY"], f"{uuid}_qrcode.png")
+        if fmt == "png" and size is None and url.qr_code != file_path:
+            write_file(file_path, image)
             url.qr_code = file_path
             url.has_qr_code = True
             url.update()
+            response_cache.bump(user_id)
+
+        return send_file(
+            io.BytesIO(image),
+            mimetype=QR_FORMATS[fmt][0],
+            as_attachment=True,
+            download_name=f"{uuid}_qrcode.{fmt}",
+            etag=etag,
+        )
+
+
+@url_namespace.route("/qr-codes.zip")
+class DownloadQRCodes(Resource):
+    """Download the QR codes of all URLs
+    Accepts [GET] requests with optional format (png or svg) and size (width in pixels) arguments
+    Returns a streamed ZIP archive with one QR code per URL
+    """
+    @limiter.limit("10/minute")
+    @jwt_required()
+    def get(self):
+        user = get_jwt_identity()
+        fmt, size = qr_format_args()
+        window = current_app.config.get("QR_ZIP_WINDOW", 64)
 
-        if os.path.exists(file_path):
-            return send_file(file_path, mimetype="image/png", as_attachment=True, download_name=f"{uuid}_qrcode.png")
-        else:
-            img = qrcode.make(f"{domain}{uuid}?referrer=qr")
-            img.save(file_path)
+        user_domain = user_context.current().custom_domain
+        domain = f"{user_domain}" if user_domain else request.host_url
 
-            return send_file(file_path, mimetype="image/png", as_attachment=True, download_name=f"{uuid}_qrcode.png")
+        return Response(
+            stream_with_context(zip_qr_codes(user, domain, fmt, size, window)),
+            mimetype="application/zip",
+            headers={"Content-Disposition": "attachment; filename=qr-codes.zip"},
+        )
 
 
 @redirect_namespace.route("<string:short_url>")
@@ -300,38 +841,19 @@ class Redirect(Resource):
     """Redirect to the original long url
     Accepts [GET] requests
     """
-    @limiter.limit("100/minute")
+    @limiter.limit(REDIRECT_LIMIT, exempt_when=rate_limit_leases.exempt_when(REDIRECT_LIMIT))
     def get(self, short_url):
-        request_domain = request.host
-        custom_domain_exists = User.query.filter_by(custom_domain=request_domain).first()
-
-        if custom_domain_exists or request.host_url == DEFAULT_DOMAIN:
-            url = Url.query.filter_by(uuid=short_url).first_or_404(description="URL Not Found")
-
-            if url:
-                long_url = url.long_url
-                referrer = url.referrer
-
-                request_referrer = request.args.get("referrer")
-
-                url.clicks += 1
-
-                try:
-                    url_referrer_dict: dict = json.loads(referrer)
-
-                except Exception as e:
-                    abort(HTTPStatus.INTERNAL_SERVER_ERROR, e)
+        if code_filter.rejects(short_url):
+            abort(HTTPStatus.NOT_FOUND, "URL Not Found")
 
-                if request_referrer:
-                    url_referrer_dict[f"{request_referrer}"] = url_referrer_dict.get(request_referrer, 0) + 1
+        if request.host_url == DEFAULT_DOMAIN or domain_registry.lookup(request.host) is not None:
+            target = resolution_cache.resolve(short_url)
 
-                else:
-                    url_referrer_dict["Unknowns"] += 1
+            if target is None:
+                abort(HTTPStatus.NOT_FOUND, "URL Not Found")
 
-                url_referrer_str = json.dumps(url_referrer_dict)
-                url.referrer = url_referrer_str
-                url.update()
-                return redirect(long_url)
+            click_buffer.record(target["id"], request.args.get("referrer"))
+            return redirect(target["long_url"])
         else:
             abort(HTTPStatus.NOT_FOUND, "URL Not Found")
 
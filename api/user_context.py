@@ -0,0 +1,79 @@
+from collections import namedtuple
+from http import HTTPStatus
+
+from flask import g
+from flask_jwt_extended import get_jwt_identity
+from flask_restx import abort
+
+from api.models import User
+from api.utils import cache, db
+
+UserProfile = namedtuple("UserProfile", ["id", "custom_domain"])
+
+
+class UserContext:
+    """Resolves the JWT identity of a request to a small immutable profile
+
+    The profile is read once per request and kept in `g`, across requests it
+    is cached for `timeout` seconds in the application cache under a key that
+    bypasses the in-process tier, so UpdateProfile.put invalidating it is
+    seen by every worker at once.
+    """
+
+    key_prefix = "user-profile/"
+
+    def __init__(self, timeout=300):
+        self.timeout = timeout
+
+    def init_app(self, app):
+        self.timeout = app.config.get("USER_CONTEXT_TIMEOUT", self.timeout)
+        app.extensions["user_context"] = self
+
+    def get(self, user_id):
+        """Return the profile of a user, None when the user does not exist
+
+        Args:
+            user_id: int
+        Return: UserProfile or None
+        """
+
+        key = f"{self.key_prefix}{user_id}"
+        try:
+            profile = cache.get(key)
+        except Exception:
+            profile = None
+        if profile is not None:
+            return profile
+
+        row = db.session.query(User.id, User.custom_domain).filter(User.id == user_id).first()
+        if row is None:
+            return None
+        profile = UserProfile(row.id, row.custom_domain)
+        try:
+            cache.set(key, profile, timeout=self.timeout)
+        except Exception:
+            pass
+        return profile
+
+    def current(self):
+        """Return the profile of the JWT identity of the request, aborts with 404 when the user does not exist"""
+
+        profile = g.get("user_profile")
+        if profile is None:
+            profile = self.get(get_jwt_identity())
+            if profile is None:
+                abort(HTTPStatus.NOT_FOUND, "User Not Found")
+            g.user_profile = profile
+        return profile
+
+    def invalidate(self, user_id):
+        """Drop the cached profile of a user after it changed"""
+
+        try:
+            cache.delete(f"{self.key_prefix}{user_id}")
+        except Exception:
+            pass
+        g.pop("user_profile", None)
+
+
+user_context = UserContext()
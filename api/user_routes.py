@@ -6,8 +6,13 @@ from flask import request
 from flask_jwt_extended import get_jwt_identity, jwt_required
 from flask_restx import Namespace, Resource, abort, fields
 
-from api.models import Url, User
-from api.utils import db, update_qr_codes
+from api.domains import domain_registry
+from api.models import QRRenderJob, Url, User
+from api.qr import qr_service
+from api.resolution import resolution_cache
+from api.response_cache import response_cache
+from api.user_context import user_context
+from api.utils import db
 
 supported_protocols = ["http", "https"]
 
@@ -34,6 +39,20 @@ user_update_output = user_namespace.model(
         "firstname": fields.String(),
         "lastname": fields.String(),
         "custom_domain": fields.String(),
+        "qr_job_id": fields.Integer(description="Id of the job re-rendering the QR codes for the new domain"),
+    },
+)
+
+qr_job_output = user_namespace.model(
+    "QR Render Job",
+    {
+        "id": fields.Integer(),
+        "status": fields.String(description="pending, running, done, superseded or failed"),
+        "total": fields.Integer(),
+        "done": fields.Integer(),
+        "error": fields.String(),
+        "created_at": fields.DateTime(),
+        "finished_at": fields.DateTime(),
     },
 )
 
@@ -94,13 +113,36 @@ class UpdateProfile(Resource):
 
             if custom_domain[-1] != "/":
                 custom_domain = f"{protocol}://{custom_domain}/"
-                update_qr_codes(user_id, custom_domain, Url)
 
             user.custom_domain = custom_domain
 
-        if remove_custom_domain:
-            update_qr_codes(user_id, request.host_url, Url)
-
         user.update()
+        user_context.invalidate(user_id)
+
+        if user_domain or remove_custom_domain:
+            domain_registry.set_owner(user_id, user.custom_domain)
+            codes = [url.uuid for url in Url.query.with_entities(Url.uuid).filter_by(user_id=user_id)]
+            resolution_cache.invalidate(*codes)
+            # cached url listings contain short urls on the old domain
+            response_cache.bump(user_id)
+            job = qr_service.start_domain_job(user_id, user.custom_domain or request.host_url)
+            user.qr_job_id = job.id if job else None
 
         return user, HTTPStatus.OK
+
+
+@user_namespace.route("/qr-jobs/<int:job_id>")
+class QRJobStatus(Resource):
+    """Get the progress of a QR code re-render job
+    Accepts [GET] request
+    Returns a serialized QR Render Job object
+    """
+    @jwt_required()
+    @user_namespace.marshal_with(qr_job_output)
+    def get(self, job_id):
+        session = db.session
+        user_id = get_jwt_identity()
+        job = session.get(QRRenderJob, job_id)
+        if job is None or job.user_id != user_id:
+            abort(HTTPStatus.NOT_FOUND, "Job Not Found")
+        return job, HTTPStatus.OK
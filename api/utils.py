@@ -1,12 +1,11 @@
+import base64
 import json
 import os
-import smtplib
-import ssl
+import threading
 from datetime import datetime, timedelta
-from email.message import EmailMessage
 
 import jwt
-import qrcode
+import sqlalchemy as sa
 from decouple import config
 from flask_caching import Cache
 from flask_limiter import Limiter
@@ -14,69 +13,19 @@ from flask_limiter.util import get_remote_address
 from flask_sqlalchemy import SQLAlchemy
 
 db = SQLAlchemy()
-cache = Cache(config={"CACHE_TYPE": "RedisCache"})
+cache = Cache()
 limiter = Limiter(
     get_remote_address,
     default_limits=["1000 per day", "100 per hour"],
-    storage_uri="memory://",
 )
 
 secret_key = config("SECRET_KEY")
-DEFAULT_DOMAIN = config("DEFAULT_DOMAIN")
 
 
 class CredentialsException(Exception):
     pass
 
 
-class MailService:
-    @staticmethod
-    def send_reset_mail(email: str, token: str, uuid: str) -> bool:
-        """Send authentication mail to the email address
-
-        Args:
-            email: str
-            token: str
-            uuid: str
-        Return: True: Bool
-        """
-
-        sender_email = config("EMAIL_SENDER")
-        sender_password = config("EMAIL_PASSWORD")
-
-        if not (sender_email and sender_password):
-            raise ValueError("Sender email and password not found in environment variables")
-
-        subject = "Password reset"
-        body = f"""
-                We have received a request to reset your password.
-                Ignore this message if you didn't make the request or click the link below to reset your password.
-                This link is only active for 10 minutes.
-                {DEFAULT_DOMAIN}auth/password-reset/{token}/{uuid}/confirm
-
-                From the Scissor team
-            """
-
-        message = EmailMessage()
-        message["subject"] = subject
-        message["From"] = sender_email
-        message["To"] = email
-        message.set_content(body)
-
-        try:
-            context = ssl.create_default_context()
-            with smtplib.SMTP_SSL("smtp.gmail.com", port=465, context=context) as server:
-                server.login(sender_email, sender_password)
-                server.send_message(message)
-        except smtplib.SMTPAuthenticationError:
-            raise ValueError("Invalid sender email or password")
-
-        except Exception as e:
-            raise ValueError("Failed to send email") from e
-
-        return True
-
-
 class TokenService:
     @staticmethod
     def create_password_reset_token(user_id: str) -> str:
@@ -140,32 +89,109 @@ class TokenService:
             raise e
 
 
-def update_qr_codes(user_id, base_url, model):
-    """Updates all qrcode images of a user on domain update
+def increment_counters(table, key_columns, rows, count_column="count"):
+    """Atomically add counts to counter rows, inserting the rows that do not exist yet
+
+    Args:
+        table: sqlalchemy Table
+        key_columns: names of the columns of the primary key
+        rows: list of dicts holding the key columns and the amount to add under count_column
+        count_column: str
+    """
+
+    if not rows:
+        return
+
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ("postgresql", "sqlite"):
+        if dialect == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert
+
+        stmt = insert(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=key_columns,
+            set_={count_column: table.c[count_column] + stmt.excluded[count_column]},
+        )
+        db.session.execute(stmt, rows)
+        return
+
+    for row in rows:
+        condition = sa.and_(*[table.c[column] == row[column] for column in key_columns])
+        result = db.session.execute(
+            sa.update(table).where(condition).values({count_column: table.c[count_column] + row[count_column]})
+        )
+        if result.rowcount == 0:
+            db.session.execute(sa.insert(table).values(row))
+
+
+def encode_cursor(timestamp, row_id):
+    """Encode the sort key of the last row of a page into an opaque cursor
 
     Args:
-        user_id: int
-        base_url: the protocol + custom domain eg. https://example.com
-    Return:
-        True
+        timestamp: datetime
+        row_id: int
+    Return: cursor: str
     """
 
-    urls = model.query.filter_by(user_id=user_id).all()
-    for url in urls:
-        if url.qr_code:
-            file_path = url.qr_code
-            if file_path and os.path.exists(file_path):
-                img = qrcode.make(f"{base_url}{url.uuid}?referrer=qr")
-                img.save(file_path)
-    return True
+    raw = json.dumps([timestamp.isoformat() if timestamp else None, row_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
 
+def decode_cursor(cursor):
+    """Decode a cursor made by encode_cursor
 
-def convert_referrer(url):
-    """Convert url referrer string to a JSON object
-    Args url: URL
+    Args:
+        cursor: str
+    Return: (timestamp, row_id): (datetime, int)
+    Raises: ValueError if the cursor is malformed
     """
+
     try:
-        referrer = json.loads(url.referrer)
-        url.referrer = referrer
-    except Exception:
-        pass
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        timestamp, row_id = json.loads(raw)
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except Exception as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def paginate_keyset(query, timestamp_column, id_column, cursor, limit):
+    """Return one page of a query ordered by (timestamp, id) and the cursor of the next page
+
+    Only rows after the cursor are read so the cost of a page does not depend on its position
+
+    Args:
+        query: sqlalchemy Query
+        timestamp_column: mapped datetime column
+        id_column: mapped primary key column
+        cursor: str or None
+        limit: int
+    Return: (rows, next_cursor): (list, str or None)
+    """
+
+    if cursor:
+        timestamp, row_id = decode_cursor(cursor)
+        query = query.filter(
+            sa.or_(timestamp_column > timestamp, sa.and_(timestamp_column == timestamp, id_column > row_id))
+        )
+    rows = query.order_by(timestamp_column, id_column).limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    last = rows[limit - 1]
+    return rows[:limit], encode_cursor(getattr(last, timestamp_column.key), getattr(last, id_column.key))
+
+
+def write_file(file_path, data):
+    """Write a file atomically so readers never see a partly written file
+
+    Args:
+        file_path: str
+        data: bytes
+    """
+
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    tmp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, file_path)
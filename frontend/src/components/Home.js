@@ -54,20 +54,31 @@ const LoggedInHome = () => {
         },
     }
 
+    // all-urls returns one page at a time, the X-Next-Cursor header points to the next page
+    const fetchAllUrls = async () => {
+        let allUrls = []
+        let cursor = null
+        do {
+            const query = cursor ? `?cursor=${encodeURIComponent(cursor)}` : ''
+            const res = await fetch(`/urls/all-urls${query}`, requestOptions)
+            allUrls = allUrls.concat(await res.json())
+            cursor = res.headers.get('X-Next-Cursor')
+        } while (cursor)
+        return allUrls
+    }
+
     useEffect(
         () => {
-            fetch('/urls/all-urls', requestOptions)
-                .then(res => res.json())
+            fetchAllUrls()
                 .then(data => {
                     setUrls(data)
                 })
                 .catch(err => console.log(err))
-        }
+        }, []
     );
 
     const getUserUrls = () => {
-        fetch('/urls/all-urls', requestOptions)
-            .then(res => res.json())
+        fetchAllUrls()
             .then(data => {
                 setUrls(data)
             })
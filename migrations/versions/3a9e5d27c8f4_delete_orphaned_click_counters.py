@@ -0,0 +1,28 @@
+"""delete orphaned click counters
+
+Revision ID: 3a9e5d27c8f4
+Revises: b7d2e91c4a10
+Create Date: 2026-10-18 20:18:44.917206
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3a9e5d27c8f4'
+down_revision = 'b7d2e91c4a10'
+branch_labels = None
+depends_on = None
+
+COUNTER_TABLES = ('url_referrer_counts', 'url_clicks_hourly', 'url_clicks_daily')
+
+
+def upgrade():
+    # SQLite does not enforce ON DELETE CASCADE without PRAGMA foreign_keys, urls deleted so far left their counters
+    for table in COUNTER_TABLES:
+        op.execute(sa.text(f"DELETE FROM {table} WHERE url_id NOT IN (SELECT id FROM urls)"))
+
+
+def downgrade():
+    pass
@@ -0,0 +1,32 @@
+"""urls sqlite autoincrement
+
+Revision ID: b7d2e91c4a10
+Revises: 0f3c60f67e5f
+Create Date: 2026-10-18 20:10:12.503118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7d2e91c4a10'
+down_revision = '0f3c60f67e5f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # SQLite reuses the id of the newest row once it is deleted, AUTOINCREMENT needs the table to be rebuilt.
+    # Ids of urls deleted before this migration above the current largest id cannot be recovered.
+    if op.get_bind().dialect.name != "sqlite":
+        return
+    with op.batch_alter_table('urls', recreate='always', table_kwargs={'sqlite_autoincrement': True}):
+        pass
+
+
+def downgrade():
+    if op.get_bind().dialect.name != "sqlite":
+        return
+    with op.batch_alter_table('urls', recreate='always', table_kwargs={'sqlite_autoincrement': False}):
+        pass
@@ -0,0 +1,36 @@
+"""url id block sequence
+
+Revision ID: f96336f637e2
+Revises: d68ca7324a6e
+Create Date: 2026-10-18 19:38:28.129900
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f96336f637e2'
+down_revision = 'd68ca7324a6e'
+branch_labels = None
+depends_on = None
+
+# must match api.codes.ID_BLOCK_SIZE
+ID_BLOCK_SIZE = 100
+
+
+def upgrade():
+    # url ids are allocated in blocks of ID_BLOCK_SIZE, the first block starts above every existing id
+    conn = op.get_bind()
+    if not conn.dialect.supports_sequences:
+        return
+    max_id = conn.execute(sa.text("SELECT MAX(id) FROM urls")).scalar() or 0
+    start = max_id // ID_BLOCK_SIZE + 1
+    op.execute(sa.schema.CreateSequence(sa.Sequence("url_id_blocks", start=start)))
+
+
+def downgrade():
+    conn = op.get_bind()
+    if not conn.dialect.supports_sequences:
+        return
+    op.execute(sa.schema.DropSequence(sa.Sequence("url_id_blocks")))